@@ -1,15 +1,39 @@
 """ Methods related to the Annual Cycle """
 import os
+import warnings
+from collections import OrderedDict
 
 import numpy as np
 from scipy.io import loadmat
 
 import pandas
+import xarray
 
 from cugn import utils as cugn_utils
 
 from IPython import embed
 
+# Location of each variable in the MATLAB A struct
+var_dict = {'t': 12, 
+            's': 13,
+            'fl': 14,
+            'oxumolkg': 16,
+            'ox': 17,  # Saturated oxygen
+            }
+xcenter_idx = 5
+
+# Name of each variable in the line datasets
+ds_vars = {'t': 'temperature',
+           's': 'salinity',
+           'fl': 'chlorophyll_a',
+           'oxumolkg': 'doxy',
+           'ox': 'SO',
+           }
+
+# Line models held in memory by load_model()
+model_cache_size = 8
+_model_cache = OrderedDict()
+
 def prep_m(Avar:np.ndarray, level:int, ip:int, nvals:int):
     maxharmonic = Avar['sin'].shape[2]
 
@@ -25,11 +49,277 @@ def prep_m(Avar:np.ndarray, level:int, ip:int, nvals:int):
 
     return m
 
-def evaluate(Aarray:np.ndarray, variable:str, level:int, time:np.ndarray, dist:np.ndarray):
+class AnnualCycleModel:
+    """ Harmonic fit of the annual cycle along a line
+
+    The nested MATLAB struct is parsed once into flat arrays
+    of coefficients per variable.
+
+    Attributes:
+        xcenter (np.ndarray): Distance bin centers (km)
+        coeffs (dict): For each variable, a dict of the 'constant' 
+            (nlevel, nbin), 'sin' and 'cos' (nlevel, nbin, maxharmonic) 
+            coefficients
+    """
+
+    def __init__(self, xcenter:np.ndarray, coeffs:dict):
+        self.xcenter = np.asarray(xcenter, dtype=float)
+        self.coeffs = coeffs
+        self._stacks = {}
+
+        # Models are shared through load_model()
+        self.xcenter.flags.writeable = False
+        for variable in self.coeffs:
+            for key in self.coeffs[variable]:
+                self.coeffs[variable][key].flags.writeable = False
+
+    @classmethod
+    def from_array(cls, Aarray:np.ndarray, variables:list=None):
+        """ Parse the MATLAB A struct
+
+        Args:
+            Aarray (np.ndarray): MATLAB array of values
+            variables (list, optional): Variables to parse. 
+                Defaults to all of var_dict.
+
+        Returns:
+            AnnualCycleModel: 
+        """
+        if variables is None:
+            variables = list(var_dict.keys())
+
+        coeffs = {}
+        for variable in variables:
+            coeffs[variable] = {}
+            for key in ['constant', 'sin', 'cos']:
+                coeffs[variable][key] = np.array(
+                    Aarray[0][0][var_dict[variable]][key][0][0], dtype=float)
+        xcenter = Aarray[0][0][xcenter_idx][:,0].astype(float)
+
+        return cls(xcenter, coeffs)
+
+    @classmethod
+    def from_mat(cls, mat_file:str):
+        """ Load and parse an anncyc .mat file
+
+        Args:
+            mat_file (str): MATLAB file
+
+        Returns:
+            AnnualCycleModel: 
+        """
+        A = loadmat(mat_file, variable_names=['A'])['A']
+        return cls.from_array(A)
+
+    @classmethod
+    def from_npz(cls, npz_file:str):
+        """ Load a model written by to_npz()
+
+        Args:
+            npz_file (str): .npz file
+
+        Returns:
+            AnnualCycleModel: 
+        """
+        coeffs = {}
+        with np.load(npz_file) as f:
+            xcenter = f['xcenter']
+            for key in f.files:
+                if key == 'xcenter':
+                    continue
+                variable, ckey = key.rsplit('_', 1)
+                coeffs.setdefault(variable, {})[ckey] = f[key]
+        return cls(xcenter, coeffs)
+
+    def to_npz(self, npz_file:str):
+        """ Write the model to a .npz file
+
+        Args:
+            npz_file (str): .npz file
+        """
+        arrays = dict(xcenter=self.xcenter)
+        for variable in self.coeffs:
+            for key in self.coeffs[variable]:
+                arrays[f'{variable}_{key}'] = self.coeffs[variable][key]
+        np.savez(npz_file, **arrays)
+
+    @property
+    def variables(self):
+        """ list: Variables in the model """
+        return list(self.coeffs.keys())
+
+    def coeff_stack(self, variable:str):
+        """ Coefficients of a variable at every level and distance bin
+
+        Args:
+            variable (str): variable
+
+        Returns:
+            np.ndarray: coefficients of shape (nlevel, nbins, 1+2*maxharmonic)
+        """
+        if variable not in self._stacks:
+            Avar = self.coeffs[variable]
+            stack = np.concatenate([Avar['constant'][:,:,None], 
+                                    Avar['sin'], Avar['cos']], axis=2)
+            stack.flags.writeable = False
+            self._stacks[variable] = stack
+        return self._stacks[variable]
+
+    def prep_m(self, variable:str, level:int):
+        """ Coefficients of a variable at every distance bin
+
+        Args:
+            variable (str): variable
+            level (int): depth level
+
+        Returns:
+            np.ndarray: coefficients of shape (nbins, 1+2*maxharmonic)
+        """
+        return self.coeff_stack(variable)[level]
+
+    def maxharmonic(self, variable:str):
+        """ Number of harmonics fit for a variable """
+        return self.coeffs[variable]['sin'].shape[2]
+
+    def bracket(self, dist:np.ndarray):
+        """ Bracket distances by the bin centers
+
+        Args:
+            dist (np.ndarray): Distance from the shore in km
+
+        Returns:
+            dict: ip (xcenter[ip] < dist <= xcenter[ip+1]), the 
+                interpolation weights, the bin width, and the
+                masks of distances below, above and off the grid
+        """
+        dist = np.asarray(dist, dtype=float)
+        xcenter = self.xcenter
+
+        ip = np.searchsorted(xcenter, dist, side='left') - 1
+        ip = np.clip(ip, 0, xcenter.size-2)
+
+        return dict(ip=ip, 
+            weights=np.stack([xcenter[ip+1]-dist, dist-xcenter[ip]], axis=1),
+            dx=np.diff(xcenter)[ip],
+            below=dist <= np.min(xcenter),
+            above=dist >= np.max(xcenter),
+            bad=~np.isfinite(dist))
+
+    def evaluate(self, variable:str, level:int, time:np.ndarray, dist:np.ndarray):
+        """ Evaluate the annual cycle
+
+        All samples are evaluated at once: the distances are bracketed
+        with a single searchsorted on the bin centers and the harmonic
+        series of both bracketing bins is evaluated with one batched
+        matrix product.
+        Distances beyond the grid take the value of the nearest bin.
+
+        Args:
+            variable (str): see var_dict
+            level (int): depth level; 0 = 10m
+            time (np.ndarray): Unix time, i.e. seconds since 1970-01-01
+            dist (np.ndarray): Distance from the shore in km
+
+        Returns:
+            np.ndarray: evals
+        """
+        G = design_matrix(time, self.maxharmonic(variable))
+        brackets = self.bracket(dist)
+
+        ip = brackets['ip']
+        m2 = self.prep_m(variable, level)[np.stack([ip, ip+1], axis=1)]
+
+        return interpolate_series(m2, G, brackets)
+
+    def evaluate_many(self, variables:list, levels:np.ndarray,
+                      time:np.ndarray, dist:np.ndarray):
+        """ Evaluate the annual cycle of several variables 
+
+        The design matrix and distance brackets are built once 
+        and shared by all of the variables and levels.
+
+        Args:
+            variables (list): variables; see var_dict
+            levels (np.ndarray): depth level of each sample
+            time (np.ndarray): Unix time, i.e. seconds since 1970-01-01
+            dist (np.ndarray): Distance from the shore in km
+
+        Returns:
+            dict: evals for each variable
+        """
+        levels = np.asarray(levels)
+        brackets = self.bracket(dist)
+        ip = brackets['ip']
+        ip2 = np.stack([ip, ip+1], axis=1)
+
+        Gs = {}
+        evals = {}
+        for variable in variables:
+            maxharmonic = self.maxharmonic(variable)
+            if maxharmonic not in Gs:
+                Gs[maxharmonic] = design_matrix(time, maxharmonic)
+            # Coefficients of the two bins bracketing each sample
+            m2 = self.coeff_stack(variable)[levels[:,None], ip2]
+            evals[variable] = interpolate_series(m2, Gs[maxharmonic], brackets)
+
+        return evals
+
+
+def design_matrix(time:np.ndarray, maxharmonic:int):
+    """ Harmonic design matrix of the annual cycle
+
+    Args:
+        time (np.ndarray): Unix time, i.e. seconds since 1970-01-01
+        maxharmonic (int): Number of harmonics
+
+    Returns:
+        np.ndarray: G of shape (ntime, 1+2*maxharmonic)
+    """
+    time = np.asarray(time, dtype=float)
+    timebin=2*np.pi*time/86400/365.25
+
+    G = np.ones((time.size, 1 + 2*maxharmonic))
+    for kk in range(maxharmonic):
+        G[:,kk+1] = np.sin(timebin * (kk+1))
+        G[:,kk+1+maxharmonic] = np.cos(timebin * (kk+1))
+
+    return G
+
+def interpolate_series(m2:np.ndarray, G:np.ndarray, brackets:dict):
+    """ Evaluate the harmonic series in the two bracketing
+    distance bins and interpolate between them
+
+    Args:
+        m2 (np.ndarray): coefficients of the two bins for each
+            sample, shape (N, 2, 1+2*maxharmonic)
+        G (np.ndarray): design matrix, shape (N, 1+2*maxharmonic)
+        brackets (dict): output of AnnualCycleModel.bracket()
+
+    Returns:
+        np.ndarray: evals
+    """
+    bracket = (m2 @ G[:,:,None])[:,:,0]
+
+    # Interpolate
+    evals = (bracket[:,None,:] @ brackets['weights'][:,:,None])[:,0,0] / brackets['dx']
+
+    # Beyond the grid
+    ii = brackets['below']
+    evals[ii] = bracket[ii,0]
+    jj = brackets['above']
+    evals[jj] = bracket[jj,1]
+
+    # Bad distances
+    evals[brackets['bad']] = np.nan
+
+    return evals
+
+def evaluate(Aarray, variable:str, level:int, time:np.ndarray, dist:np.ndarray):
     """ Evaluate the annual cycle
 
     Args:
-        Aarray (np.ndarray): MATLAB array of values
+        Aarray (np.ndarray or AnnualCycleModel): MATLAB array of values
+            or its parsed model
         variable (str): allowed values are 
             't' (temperature)
             's' (salinity)
@@ -40,69 +330,87 @@ def evaluate(Aarray:np.ndarray, variable:str, level:int, time:np.ndarray, dist:n
     Returns:
         np.ndarray: evals
     """
-    var_dict = {'t': 12, 
-                's': 13,
-                'fl': 14,
-                'oxumolkg': 16,
-                'ox': 17,  # Saturated oxygen
-                }
-    idx = var_dict[variable]
-
-    evals = np.zeros(time.size)
-    
-    # Unpack A for convenience
-    A = {}
-    A[variable] = {}
-    for key in ['constant', 'sin', 'cos']:
-        # Temperature
-        A[variable][key] = Aarray[0][0][idx][key][0][0]
-    A['xcenter'] = Aarray[0][0][5][:,0].astype(float)
+    if isinstance(Aarray, AnnualCycleModel):
+        model = Aarray
+    else:
+        model = AnnualCycleModel.from_array(Aarray, variables=[variable])
 
-    #embed(header='54 of annualcycle.py')
+    return model.evaluate(variable, level, time, dist)
 
-    # Prep
-    timebin=2*np.pi*time/86400/365.25
-    maxharmonic = A[variable]['sin'].shape[2]
+def anncyc_file(line:str, ext:str='mat'):
+    """ Name of the annual cycle file for a line
 
-    # Build G
-    G = np.ones((time.size, 1 + 2*maxharmonic))
-    for kk in range(maxharmonic):
-        G[:,kk+1] = np.sin(timebin * (kk+1))
-        G[:,kk+1+maxharmonic] = np.cos(timebin * (kk+1))
+    Args:
+        line (str): line
+        ext (str, optional): 'mat' or 'npz'. Defaults to 'mat'.
 
-    # Beyond the grid
-    ii = dist <= np.min(A['xcenter'])
-    if np.any(ii):
-        idx = np.where(ii)[0]
-        m = prep_m(A[variable], level, 0, 1)
-        evals[idx] = (G[idx,:] @ m.T).flatten()
-
-    jj = dist >= np.max(A['xcenter'])
-    if np.any(jj):
-        idx = np.where(jj)[0]
-        m = prep_m(A[variable], level, -1, 1)
-        evals[idx] = (G[idx,:] @ m.T).flatten()
-
-    # Within the grid
-    dx = np.diff(A['xcenter'])
-
-    ip = np.where(~ii & ~jj)[0]
-    for n in ip:
-        xx = A['xcenter'] - dist[n]
-        # Find the zero crossing
-        ip = np.where(xx[:-1] * xx[1:] <= 0)[0][0]
-        # Prep
-        m2 = prep_m(A[variable], level, ip, 2)
-        # Evaluate
-        bracket = G[n:n+1,:] @ m2.T
-
-        evals[n] =  float(bracket @ [xx[ip+1], -xx[ip]]) / dx[ip]
+    Returns:
+        str: filename
+    """
+    return os.path.join(os.getenv('CUGN'), 
+                        f'anncyc{int(float(line))}.{ext}')
 
+def clear_model_cache():
+    """ Empty the in-memory cache of load_model() """
+    _model_cache.clear()
 
-    return evals
+def _trim_model_cache():
+    """ Drop the least recently used models beyond model_cache_size """
+    while len(_model_cache) > max(model_cache_size, 0):
+        _model_cache.popitem(last=False)
+
+def load_model(line:str, use_npz:bool=True):
+    """ Load the annual cycle model of a line
+
+    Models are kept in memory, up to model_cache_size of them,
+    keyed by the modification time of the .mat file so a refreshed
+    fit is picked up.  With use_npz, the parsed model is read from
+    (or written to) a .npz sidecar of the .mat file so that loadmat 
+    is only run once per line.  If the sidecar cannot be written,
+    e.g. in a read-only directory, the parsed model is used as is.
+
+    Args:
+        line (str): line
+        use_npz (bool, optional): Use the .npz sidecar. Defaults to True.
+
+    Returns:
+        AnnualCycleModel: 
+    """
+    mat_file = anncyc_file(line)
+    npz_file = anncyc_file(line, ext='npz')
+    mat_mtime = os.path.getmtime(mat_file) if os.path.isfile(mat_file) else None
+
+    # In memory?
+    key = (line, use_npz, mat_mtime)
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        model = _model_cache[key]
+        _trim_model_cache()
+        return model
+
+    if use_npz and os.path.isfile(npz_file) and (
+        mat_mtime is None or os.path.getmtime(npz_file) >= mat_mtime):
+        model = AnnualCycleModel.from_npz(npz_file)
+    else:
+        model = AnnualCycleModel.from_mat(mat_file)
+        if use_npz:
+            try:
+                model.to_npz(npz_file)
+                print(f"Wrote: {npz_file}")
+            except OSError as err:
+                warnings.warn(f"Could not write {npz_file}: {err}")
+
+    # Cache, dropping any older fit of the line
+    for old_key in [ikey for ikey in _model_cache if ikey[:2] == key[:2]]:
+        del _model_cache[old_key]
+    _model_cache[key] = model
+    _trim_model_cache()
+
+    return model
 
 def calc_for_grid(grid:pandas.DataFrame, 
-                  line:str, variable:str):
+                  line:str, variable:str,
+                  model:AnnualCycleModel=None):
     """
     Calculate the annual cycle values for a given grid.
 
@@ -112,14 +420,36 @@ def calc_for_grid(grid:pandas.DataFrame,
         variable (str): The variable to calculate the annual cycle for.
             't': temperature
             'oxumolkg': dissolved oxygen
+        model (AnnualCycleModel, optional): The annual cycle model.
+            Defaults to load_model(line).
 
     Returns:
         numpy.ndarray: The calculated annual cycle.
     """
+    return batch_calc_for_grid(grid, line, [variable], model=model)[variable]
+
+def batch_calc_for_grid(grid:pandas.DataFrame, line:str,
+                        variables:list, model:AnnualCycleModel=None):
+    """
+    Calculate the annual cycle values of several variables for a given grid.
+
+    Distances, times, the design matrix and the distance brackets
+    are computed once for all variables and depth levels.
+
+    Args:
+        grid (pandas.DataFrame): The grid data.
+        line (str): The line identifier.
+        variables (list): The variables to calculate the annual cycle for,
+            e.g. ['oxumolkg', 'ox']; see var_dict
+        model (AnnualCycleModel, optional): The annual cycle model.
+            Defaults to load_model(line).
+
+    Returns:
+        dict: The calculated annual cycle for each variable.
+    """
     # Load up
-    anncyc_file = os.path.join(os.getenv('CUGN'), 
-                               f'anncyc{int(float(line))}.mat')
-    A = loadmat(anncyc_file, variable_names=['A'])['A']
+    if model is None:
+        model = load_model(line)
 
     # Distance
     dist, offset = cugn_utils.calc_dist_offset(line, grid.lon.values, grid.lat.values)
@@ -128,15 +458,71 @@ def calc_for_grid(grid:pandas.DataFrame,
     unix_time = (grid.time - pandas.Timestamp("1970-01-01")) / pandas.Timedelta('1s')
 
     # Evaluate
-    uni_depth = np.unique(grid.depth.values)
-    T_Annual = np.zeros(unix_time.size)
-
-    # Loop on depth
-    for level in uni_depth:
-        in_depth = grid.depth == level
-        # 
-        T_Annual[in_depth] = evaluate(A, variable, level, 
-                                      unix_time[in_depth], dist[in_depth])
-
-    # Return
-    return T_Annual
\ No newline at end of file
+    return model.evaluate_many(variables, grid.depth.values, 
+                               unix_time.values, dist)
+
+def calc_for_ds(ds:xarray.Dataset, line:str, variables:list,
+                anomalies:bool=False, chunk_size:int=1000,
+                model:AnnualCycleModel=None):
+    """
+    Evaluate the annual cycle at every (depth, profile) of a line dataset.
+
+    The profiles are processed in chunks of chunk_size so that 
+    the memory of the intermediate arrays is bounded.  Depth levels
+    beyond those of the model are set to NaN.
+
+    The dataset is modified in place with an ann_<name> variable 
+    for each variable (and anom_<name> = <name> - ann_<name> if anomalies 
+    is True) where <name> is the dataset name given by ds_vars.
+
+    Args:
+        ds (xarray.Dataset): The line dataset, e.g. CUGN_potential_line_90.nc
+        line (str): The line identifier.
+        variables (list): The variables to calculate the annual cycle for; 
+            see var_dict
+        anomalies (bool, optional): Also add the anomalies. Defaults to False.
+        chunk_size (int, optional): Number of profiles per chunk. Defaults to 1000.
+        model (AnnualCycleModel, optional): The annual cycle model.
+            Defaults to load_model(line).
+    """
+    # Load up
+    if model is None:
+        model = load_model(line)
+
+    ndepth, nprof = ds.depth.size, ds.profile.size
+    nlevel = min(ndepth, min([model.coeff_stack(variable).shape[0] 
+                              for variable in variables]))
+
+    annual = {}
+    for variable in variables:
+        annual[variable] = np.full((ndepth, nprof), np.nan)
+
+    # Unix time
+    unix_time = (ds.time.values - np.datetime64('1970-01-01')) / np.timedelta64(1, 's')
+    
+    # Loop on chunks of profiles
+    for start in range(0, nprof, chunk_size):
+        end = min(start+chunk_size, nprof)
+        nchunk = end - start
+
+        # Distance
+        dist, _ = cugn_utils.calc_dist_offset(
+            line, ds.lon.values[start:end], ds.lat.values[start:end])
+
+        # Flatten (depth, profile) 
+        levels = np.repeat(np.arange(nlevel), nchunk)
+        evals = model.evaluate_many(variables, levels,
+                                    np.tile(unix_time[start:end], nlevel),
+                                    np.tile(dist, nlevel))
+        for variable in variables:
+            annual[variable][:nlevel, start:end] = evals[variable].reshape(
+                nlevel, nchunk)
+
+    # Add to ds
+    for variable in variables:
+        name = ds_vars[variable]
+        ds[f'ann_{name}'] = (('depth', 'profile'), annual[variable])
+        ds[f'ann_{name}'].attrs = dict(long_name=f'Annual cycle of {name}')
+        if anomalies and name in ds:
+            ds[f'anom_{name}'] = ds[name] - ds[f'ann_{name}']
+            ds[f'anom_{name}'].attrs = dict(long_name=f'Anomaly of {name}')
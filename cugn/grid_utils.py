@@ -1,6 +1,10 @@
 """ Module for grid utilities. """
 # imports
 import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import xarray
 
 import numpy as np
@@ -19,114 +23,1218 @@ default_bins = dict(SA=np.linspace(32.1, 34.8, 50),
                 doxy=np.linspace(0., 380, 100),
                 z=np.linspace(0., 500, 50),
                 N=np.linspace(0., 25, 100),
-                CT=np.linspace(4, 22.5, 50))
+                CT=np.linspace(4, 22.5, 50),
+                depth=np.linspace(0., 500, 11),
+                doy=np.linspace(1., 367, 13))
+
+def pack_rowcol(rows, cols):
+    """ Pack (row, col) into a single integer key
+
+    Keys sort by col and then by row.
+
+    Args:
+        rows (int or np.ndarray): 
+        cols (int or np.ndarray): 
+
+    Returns:
+        int or np.ndarray: col*10000 + row
+    """
+    return np.asarray(cols, dtype=np.int64)*10000 + np.asarray(rows, dtype=np.int64)
+
+class CellIndex:
+    """ CSR-style index of the table rows falling in each (row, col) cell
+
+    The rows are stably sorted by their packed (row, col) key so
+    that the rows of any one cell are a contiguous slice of the
+    sorted permutation.  Per-cell lookups are then O(cell size)
+    instead of a scan of the full table.
+
+    Attributes:
+        cell_rows (np.ndarray): row of each occupied cell
+        cell_cols (np.ndarray): col of each occupied cell
+        offsets (np.ndarray): start of each cell in perm; 
+            has one more entry than there are cells
+        perm (np.ndarray): table positions sorted by cell
+    """
+
+    def __init__(self, cell_rows:np.ndarray, cell_cols:np.ndarray,
+                 offsets:np.ndarray, perm:np.ndarray):
+        self.cell_rows = np.asarray(cell_rows, dtype=np.int64)
+        self.cell_cols = np.asarray(cell_cols, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.perm = np.asarray(perm, dtype=np.int64)
+
+        self.keys = pack_rowcol(self.cell_rows, self.cell_cols)
+        self._cell_of = None
+
+    @classmethod
+    def from_rowcol(cls, rows:np.ndarray, cols:np.ndarray):
+        """ Build the index from the row, col of every entry
+
+        Args:
+            rows (np.ndarray): row of each entry
+            cols (np.ndarray): col of each entry
+
+        Returns:
+            CellIndex: 
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        keys = pack_rowcol(rows, cols)
+        perm = np.argsort(keys, kind='stable')
+        uni_keys, starts, counts = np.unique(keys[perm], return_index=True,
+                                             return_counts=True)
+
+        offsets = np.zeros(uni_keys.size+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+
+        # Take the row, col of the first entry of each cell, as the
+        #  packed keys do not decode for off-grid rows (e.g. -1)
+        first = perm[starts]
+
+        return cls(rows[first], cols[first], offsets, perm)
+
+    @classmethod
+    def from_table(cls, grid_tbl:pandas.DataFrame):
+        """ Build the index from a grid table
+
+        Args:
+            grid_tbl (pandas.DataFrame): table with row, col columns
+
+        Returns:
+            CellIndex: 
+        """
+        return cls.from_rowcol(grid_tbl.row.values, grid_tbl.col.values)
+
+    @classmethod
+    def from_grid_indices(cls, grid_indices:np.ndarray):
+        """ Build the index from the grid_indices of gen_grid
+
+        Args:
+            grid_indices (np.ndarray): 1-based bin numbers, 
+                shape (2, N), as returned by gen_grid
+
+        Returns:
+            CellIndex: indexed by 0-based row, col
+        """
+        return cls.from_rowcol(grid_indices[0]-1, grid_indices[1]-1)
+
+    @classmethod
+    def load(cls, infile:str):
+        """ Load an index written by save()
+
+        Args:
+            infile (str): .npz file
+
+        Returns:
+            CellIndex: 
+        """
+        f = np.load(infile)
+        return cls(f['cell_rows'], f['cell_cols'], 
+                   f['offsets'], f['perm'])
+
+    def save(self, outfile:str):
+        """ Write the index to a .npz file
+
+        Args:
+            outfile (str): .npz file
+        """
+        np.savez(outfile, cell_rows=self.cell_rows, 
+                 cell_cols=self.cell_cols,
+                 offsets=self.offsets, perm=self.perm)
+
+    def __len__(self):
+        return self.keys.size
+
+    def matches(self, grid_tbl:pandas.DataFrame):
+        """ Check the index was built for a grid table
+
+        The number of rows is always compared;  the cell of
+        every row is too if the table has row, col columns.
+
+        Args:
+            grid_tbl (pandas.DataFrame): table
+
+        Returns:
+            bool: 
+        """
+        if self.nrows != len(grid_tbl):
+            return False
+        if 'row' not in grid_tbl.columns or 'col' not in grid_tbl.columns:
+            return True
+        keys = pack_rowcol(grid_tbl.row.values, grid_tbl.col.values)
+        return bool(np.array_equal(keys[self.perm], 
+                                   np.repeat(self.keys, self.counts)))
+
+    @property
+    def nrows(self):
+        """ int: Number of entries indexed """
+        return self.perm.size
+
+    @property
+    def counts(self):
+        """ np.ndarray: Number of entries in each cell """
+        return np.diff(self.offsets)
+
+    @property
+    def cell_of(self):
+        """ np.ndarray: Cell number of each entry (in table order) """
+        if self._cell_of is None:
+            self._cell_of = np.empty(self.nrows, dtype=np.int64)
+            self._cell_of[self.perm] = np.repeat(
+                np.arange(len(self)), self.counts)
+        return self._cell_of
+
+    def find_cell(self, row:int, col:int):
+        """ Find the cell number of a given (row, col)
+
+        Args:
+            row (int): 
+            col (int): 
+
+        Returns:
+            int: cell number or -1 if the cell is empty
+        """
+        key = pack_rowcol(row, col)
+        icell = np.searchsorted(self.keys, key)
+        if icell < len(self) and self.keys[icell] == key and \
+                self.cell_rows[icell] == row and self.cell_cols[icell] == col:
+            return int(icell)
+        return -1
+
+    def lookup(self, row:int, col:int):
+        """ Table positions of the entries in a given cell
+
+        Args:
+            row (int): 
+            col (int): 
+
+        Returns:
+            np.ndarray: positions, in table order; empty if the cell is unoccupied
+        """
+        icell = self.find_cell(row, col)
+        if icell < 0:
+            return np.zeros(0, dtype=np.int64)
+        return self.perm[self.offsets[icell]:self.offsets[icell+1]]
+
+
+def table_cell_index(grid_tbl:pandas.DataFrame, cell_index:CellIndex=None):
+    """ Index of a grid table by cell
+
+    Args:
+        grid_tbl (pandas.DataFrame): table with row, col columns
+        cell_index (CellIndex, optional): Index to check against 
+            grid_tbl. Built from grid_tbl if not provided.
+
+    Raises:
+        IOError: cell_index does not match grid_tbl
+
+    Returns:
+        CellIndex: 
+    """
+    if cell_index is None:
+        return CellIndex.from_table(grid_tbl)
+    if not cell_index.matches(grid_tbl):
+        raise IOError("cell_index does not match grid_tbl")
+    return cell_index
+
+def bin_numbers(values:np.ndarray, edges:np.ndarray):
+    """ Digitize values onto a set of bin edges
+
+    Follows scipy.stats.binned_statistic_dd:  0 is below the first
+    edge, len(edges) is above the last and values on the last edge
+    fall in the last bin.
+
+    Args:
+        values (np.ndarray): Values to digitize
+        edges (np.ndarray): Bin edges
+
+    Returns:
+        np.ndarray: 1-based bin numbers
+    """
+    values = np.asarray(values, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+    ibin = np.digitize(values, edges)
+
+    # Shift points on the rightmost edge into the last bin
+    dedges_min = np.diff(edges).min()
+    if dedges_min == 0:
+        raise IOError('The smallest edge difference is numerically 0.')
+    decimal = int(-np.log10(dedges_min)) + 6
+    on_edge = (values >= edges[-1]) & (
+        np.around(values, decimal) == np.around(edges[-1], decimal))
+    ibin[on_edge] -= 1
+
+    return ibin
+
+class GridBinning:
+    """ Bin assignment of every (depth, profile) point of a dataset
+
+    The bin numbers follow bin_numbers(), i.e. they are 1-based with
+    0 and len(edges) for points off the grid.  Once built, any
+    variable of the dataset can be gridded with np.bincount
+    without digitizing the axes again.
+
+    Attributes:
+        axes (tuple): names of the gridding axes
+        edges (list): bin edges along each axis
+        bins (np.ndarray): bin numbers, shape (naxes, ndepth, nprofile)
+        valid (np.ndarray): True where all of the axes are finite, 
+            shape (ndepth, nprofile)
+    """
+
+    def __init__(self, axes:tuple, edges:list, bins:np.ndarray,
+                 valid:np.ndarray):
+        self.axes = tuple(axes)
+        self.edges = [np.asarray(iedges, dtype=float) for iedges in edges]
+        self.bins = np.asarray(bins)
+        self.valid = np.asarray(valid, dtype=bool)
+
+    @classmethod
+    def from_ds(cls, ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'),
+                bins:dict=None):
+        """ Digitize the axes of a dataset
+
+        Args:
+            ds (xarray.Dataset): dataset
+            axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+            bins (dict, optional): bin edges of each axis. Defaults to default_bins.
+
+        Returns:
+            GridBinning: 
+        """
+        if bins is None:
+            bins = default_bins
+        edges = [np.asarray(bins[key], dtype=float) for key in axes]
+
+        valid = np.ones((ds.depth.size, ds.profile.size), dtype=bool)
+        data = [variable_data(ds, key) for key in axes]
+        for idata in data:
+            valid &= np.isfinite(idata)
+
+        # Smallest integer type that holds the bin numbers
+        dtype = np.int16 if max([len(iedges) for iedges in edges]) < 2**15 \
+            else np.int32
+        ibins = np.zeros((len(axes),) + valid.shape, dtype=dtype)
+        for kk, idata in enumerate(data):
+            ibins[kk][valid] = bin_numbers(idata[valid], edges[kk])
+
+        return cls(axes, edges, ibins, valid)
+
+    @classmethod
+    def load(cls, infile:str):
+        """ Load a binning written by save()
+
+        Args:
+            infile (str): .npz file
+
+        Returns:
+            GridBinning: 
+        """
+        f = np.load(infile)
+        axes = tuple([str(key) for key in f['axes']])
+        edges = [f[f'edges_{key}'] for key in axes]
+        return cls(axes, edges, f['bins'], f['valid'])
+
+    def save(self, outfile:str):
+        """ Write the binning to a .npz file
+
+        Args:
+            outfile (str): .npz file
+        """
+        edges = {f'edges_{key}': iedges for key, iedges in zip(self.axes, self.edges)}
+        np.savez(outfile, axes=np.array(self.axes), bins=self.bins,
+                 valid=self.valid, **edges)
+
+    @property
+    def shape(self):
+        """ tuple: (ndepth, nprofile) of the dataset """
+        return self.valid.shape
+
+    @property
+    def nbin(self):
+        """ tuple: Number of bins along each axis, including the outlier bins """
+        return tuple([len(iedges)+1 for iedges in self.edges])
+
+    @property
+    def rows(self):
+        """ np.ndarray: 0-based row (first axis) of each point """
+        return self.bins[0].astype(np.int64) - 1
+
+    @property
+    def cols(self):
+        """ np.ndarray: 0-based col (second axis) of each point """
+        return self.bins[1].astype(np.int64) - 1
+
+    def matches(self, ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'), 
+                bins:dict=None):
+        """ Check the binning was built for this dataset shape and bin spec
+
+        Args:
+            ds (xarray.Dataset): dataset
+            axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+            bins (dict, optional): bin edges of each axis. Defaults to default_bins.
+
+        Returns:
+            bool: 
+        """
+        if bins is None:
+            bins = default_bins
+        if tuple(axes) != self.axes:
+            return False
+        if self.shape != (ds.depth.size, ds.profile.size):
+            return False
+        for key, iedges in zip(axes, self.edges):
+            if not np.array_equal(np.asarray(bins[key], dtype=float), iedges):
+                return False
+        return True
+
+    def isel_profiles(self, keep:np.ndarray):
+        """ Binning of a subset of the profiles
+
+        Args:
+            keep (np.ndarray): boolean mask or indices of the profiles
+
+        Returns:
+            GridBinning: 
+        """
+        return GridBinning(self.axes, self.edges, self.bins[:, :, keep], 
+                           self.valid[:, keep])
+
+    def binnumbers(self, mask:np.ndarray=None):
+        """ Flattened bin numbers, including the outlier bins
+
+        Args:
+            mask (np.ndarray, optional): (depth, profile) points to 
+                select. Defaults to the valid points.
+
+        Returns:
+            np.ndarray: 
+        """
+        if mask is None:
+            mask = self.valid
+        return np.ravel_multi_index(
+            [ibins[mask] for ibins in self.bins], self.nbin)
+
+
+def cached_binning(ds:xarray.Dataset, binning_file:str, 
+                   axes:tuple=('SA', 'sigma0'), bins:dict=None,
+                   datafile:str=None):
+    """ Load the binning of a dataset from disk, 
+    building and writing it if it is missing or stale
+
+    Args:
+        ds (xarray.Dataset): dataset
+        binning_file (str): .npz file; see cugn_io.binning_file()
+        axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+        bins (dict, optional): bin edges of each axis. Defaults to default_bins.
+        datafile (str, optional): file the dataset was read from.  The
+            binning is rebuilt if this file is newer. Defaults to None.
+
+    Returns:
+        GridBinning: 
+    """
+    if os.path.isfile(binning_file):
+        fresh = datafile is None or (
+            os.path.getmtime(binning_file) >= os.path.getmtime(datafile))
+        if fresh:
+            binning = GridBinning.load(binning_file)
+            if binning.matches(ds, axes=axes, bins=bins):
+                return binning
+
+    # Build and save
+    binning = GridBinning.from_ds(ds, axes=axes, bins=bins)
+    binning.save(binning_file)
+    print(f"Wrote: {binning_file}")
+
+    return binning
+
+def load_binning(line:str, ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'),
+                 bins:dict=None):
+    """ Binning of the potential file of a line, cached on disk
+
+    Args:
+        line (str): line
+        ds (xarray.Dataset): dataset of the line, e.g. from cugn_io.load_line()
+        axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+        bins (dict, optional): bin edges of each axis. Defaults to default_bins.
+
+    Returns:
+        GridBinning: 
+    """
+    lfiles = cugn_io.line_files(line)
+    binning_file = lfiles['binning_file']
+    if tuple(axes) != ('SA', 'sigma0'):
+        binning_file = binning_file.replace(
+            '_binning.npz', f'_binning_{"_".join(axes)}.npz')
+
+    return cached_binning(ds, binning_file, axes=axes, bins=bins,
+                          datafile=lfiles['datafile'])
+
+def variable_data(ds:xarray.Dataset, variable:str):
+    """ Grab the (depth, profile) data for a variable
+
+    Args:
+        ds (xarray.Dataset): dataset
+        variable (str): variable name; 'depth' and the
+            day of year of each profile, 'doy', are expanded
+            onto the (depth, profile) grid
+
+    Returns:
+        np.ndarray: 2D array of the values
+    """
+    if variable in ['depth']:
+        return np.outer(ds.depth.data, np.ones_like(ds.profile))
+    if variable in ['doy']:
+        doy = pandas.to_datetime(ds.time.values).dayofyear.values
+        return np.outer(np.ones_like(ds.depth.data), doy).astype(float)
+    return ds[variable].data
+
+def sort_groups(keys:np.ndarray, values:np.ndarray):
+    """ Sort values by group key and then by value
+
+    Args:
+        keys (np.ndarray): group key of each value
+        values (np.ndarray): values
+
+    Returns:
+        tuple: unique keys, start of each group in the sorted values, 
+            size of each group, sorted values
+    """
+    isort = np.lexsort((values, keys))
+    uni_keys, starts, counts = np.unique(keys[isort],
+                                         return_index=True, return_counts=True)
+    return uni_keys, starts, counts, values[isort]
+
+def grouped_quantile(keys:np.ndarray, values:np.ndarray, q,
+                     groups:tuple=None):
+    """ Quantiles of the values in each group
+
+    The values are sorted by group and then by value so each 
+    group is a sorted segment;  the quantiles are then taken
+    from the segment offsets with the default 'linear' method
+    of np.quantile.
+
+    Args:
+        keys (np.ndarray): group key of each value
+        values (np.ndarray): values
+        q (float or np.ndarray): quantile(s), between 0 and 1
+        groups (tuple, optional): output of sort_groups(keys, values),
+            to avoid sorting again. Defaults to None.
+
+    Returns:
+        tuple: unique keys (np.ndarray), quantiles (np.ndarray)
+            with shape q.shape + (nkeys,)
+    """
+    if groups is None:
+        groups = sort_groups(keys, values)
+    uni_keys, starts, counts, svalues = groups
+
+    # Virtual index within each segment
+    q = np.asarray(q, dtype=float)
+    if np.any((q < 0.) | (q > 1.)):
+        raise IOError("Quantiles must be between 0 and 1")
+    vidx = np.multiply.outer(q, counts-1)
+    lo = np.floor(vidx).astype(np.int64)
+    hi = np.minimum(lo+1, counts-1)
+    gamma = vidx - lo
+
+    # Interpolate as numpy does
+    a = svalues[starts + lo]
+    b = svalues[starts + hi]
+    diff_b_a = b - a
+    quant = np.where(gamma >= 0.5, b - diff_b_a * (1 - gamma), 
+                     a + diff_b_a * gamma)
+
+    return uni_keys, quant
+
+def flat_stats(binnumbers:np.ndarray, values:np.ndarray, 
+               nflat:int, stats:tuple=('mean',)):
+    """ Calculate a set of statistics of values in each of nflat bins
+
+    mean, std, median, count, sum, min and max
+    follow scipy.stats.binned_statistic_dd.  Percentiles are
+    given as 'pNN', e.g. 'p5' or 'p97.5', and a callable is
+    evaluated on the values of each occupied bin.  The values
+    are sorted at most once for all of the order statistics.
+
+    Args:
+        binnumbers (np.ndarray): Bin number of each value, 0 to nflat-1
+        values (np.ndarray): Values
+        nflat (int): Number of bins
+        stats (tuple, optional): Statistics. Defaults to ('mean',).
+
+    Returns:
+        dict: statistic of each bin, keyed by stat;  empty bins 
+            are 0 for count and sum and NaN otherwise
+    """
+    groups = None
+
+    items = {}
+    for stat in stats:
+        result = np.full(nflat, np.nan)
+        if isinstance(stat, str) and stat in ['count', 'sum']:
+            weights = None if stat == 'count' else values
+            result = np.bincount(binnumbers, weights, minlength=nflat).astype(float)
+        elif isinstance(stat, str) and stat in ['mean', 'std']:
+            flatcount = np.bincount(binnumbers, minlength=nflat)
+            a = flatcount.nonzero()
+            flatsum = np.bincount(binnumbers, values, minlength=nflat)
+            if stat == 'mean':
+                result[a] = flatsum[a] / flatcount[a]
+            else:
+                delta = values - flatsum[binnumbers] / flatcount[binnumbers]
+                result[a] = np.sqrt(
+                    np.bincount(binnumbers, delta*delta, minlength=nflat)[a] 
+                    / flatcount[a])
+        elif isinstance(stat, str) and stat == 'min':
+            i = np.argsort(values)[::-1]  # Reversed so the min is last
+            result[binnumbers[i]] = values[i]
+        elif isinstance(stat, str) and stat == 'max':
+            i = np.argsort(values)
+            result[binnumbers[i]] = values[i]
+        elif callable(stat) or stat == 'median' or stat.startswith('p'):
+            # Sort by cell then value
+            if groups is None:
+                groups = sort_groups(binnumbers, values)
+            cells, j, counts, svalues = groups
+            if callable(stat):
+                for cell, j0, n in zip(cells, j, counts):
+                    result[cell] = stat(svalues[j0:j0+n])
+            elif stat == 'median':
+                mid = j + (counts - 1) / 2
+                mid_a = svalues[np.floor(mid).astype(int)]
+                mid_b = svalues[np.ceil(mid).astype(int)]
+                result[cells] = (mid_a + mid_b) / 2
+            else:
+                try:
+                    perc = float(stat[1:])
+                except ValueError:
+                    raise IOError(f"Bad statistic: {stat}")
+                _, result[cells] = grouped_quantile(
+                    binnumbers, values, perc/100., groups=groups)
+        else:
+            raise IOError(f"Bad statistic: {stat}")
+        items[stat] = result
+
+    return items
+
+def binned_stats(binnumbers:np.ndarray, values:np.ndarray, 
+                 nbin:tuple, stats:tuple=('mean',)):
+    """ Calculate a set of statistics of values on a flattened grid
+
+    See flat_stats() for the statistics.
+
+    Args:
+        binnumbers (np.ndarray): Flattened bin number of each value,
+            including the outlier bins
+        values (np.ndarray): Values
+        nbin (tuple): Number of bins along each axis, including the
+            outlier bins
+        stats (tuple, optional): Statistics. Defaults to ('mean',).
+
+    Returns:
+        dict: statistic on the grid, without the outlier bins, keyed by stat
+    """
+    items = flat_stats(binnumbers, values, int(np.prod(nbin)), stats=stats)
+
+    # Remove the outlier bins
+    core = tuple(len(nbin) * [slice(1, -1)])
+    for stat in items.keys():
+        items[stat] = items[stat].reshape(nbin)[core]
+
+    return items
+
+def binned_stat(binnumbers:np.ndarray, values:np.ndarray, 
+                nbin:tuple, stat:str='mean'):
+    """ Calculate a statistic of values on a flattened grid
+
+    See flat_stats() for the statistics.
+
+    Args:
+        binnumbers (np.ndarray): Flattened bin number of each value,
+            including the outlier bins
+        values (np.ndarray): Values
+        nbin (tuple): Number of bins along each axis, including the
+            outlier bins
+        stat (str, optional): Statistic. Defaults to 'mean'.
+
+    Returns:
+        np.ndarray: statistic on the grid without the outlier bins
+    """
+    return binned_stats(binnumbers, values, nbin, stats=(stat,))[stat]
+
+def binned_points(ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'),
+                  bins:dict=None, max_depth:int=None,
+                  binning:GridBinning=None):
+    """ Binning of a dataset and the points to grid
+
+    Args:
+        ds (xarray.Dataset): dataset
+        axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+        bins (dict, optional): bin edges of each axis. Defaults to default_bins.
+        max_depth (int, optional): maximum depth to grid. Defaults to None.
+        binning (GridBinning, optional): Pre-computed binning of ds. Defaults to None.
+
+    Returns:
+        tuple: GridBinning, (depth, profile) mask of the points to grid
+    """
+    if binning is None:
+        binning = GridBinning.from_ds(ds, axes=axes, bins=bins)
+    elif binning.shape != (ds.depth.size, ds.profile.size):
+        raise IOError("The binning does not match the dataset")
+
+    # Cut on good data
+    gd = binning.valid.copy()
+    if max_depth is not None:
+        depths = np.outer(ds.depth.data, np.ones_like(ds.profile))
+        gd &= depths <= max_depth
+
+    return binning, gd
+
+def gen_grids(ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'),
+              variables:tuple=('doxy',), stats:tuple=('mean',),
+              bins:dict=None, max_depth:int=None,
+              binning:GridBinning=None):
+    """
+    Generate gridded statistics for a set of variables from a 
+    single binning of the dataset.
+
+    Parameters:
+        - ds (xarray.Dataset): The dataset containing the variables.
+        - axes (tuple, optional): The axes to use for gridding. Default is ('SA', 'sigma0').
+        - variables (tuple, optional): The variables to grid. Default is ('doxy',).
+        - stats (tuple, optional): The statistics to compute for each grid cell,
+            any of mean, median, std, count, sum, min, max or 'pNN' percentiles.
+            Default is ('mean',).
+        - bins (dict, optional): The binning scheme for each axis. Default is None.
+        - max_depth (int, optional): The maximum depth to consider for gridding. Default is None.
+        - binning (GridBinning, optional): Pre-computed binning of ds; its axes and
+            bins take the place of axes and bins. Default is None.
+    Returns:
+        dict: 
+        - edges: list of the bin edges along each axis.
+        - counts: The number of data points in each grid cell.
+        - grids: dict of dicts of the statistics, e.g. grids['doxy']['mean'].
+            Each variable also holds its own 'count' of finite values.
+        - binnumbers: The flattened bin number (with outlier bins) of each data point.
+        - nbin: The number of bins along each axis, including the outlier bins.
+        - gd: A boolean mask indicating which data points were binned.
+    """
+    # Default bins -- Line 90
+    if bins is None:
+        bins = default_bins
+
+    # Digitize once
+    binning, gd = binned_points(ds, axes=axes, bins=bins, 
+                                max_depth=max_depth, binning=binning)
+    edges, nbin = binning.edges, binning.nbin
+    binnumbers = binning.binnumbers(gd)
+
+    # Counts
+    counts = binned_stat(binnumbers, None, nbin, stat='count')
+
+    # Statistics
+    grids = {}
+    for variable in variables:
+        values = variable_data(ds, variable)[gd]
+        ok = np.isfinite(values)
+        grids[variable] = binned_stats(binnumbers[ok], values[ok], nbin,
+                                       stats=('count',) + tuple(stats))
+
+    # Return
+    return dict(edges=edges, counts=counts, grids=grids,
+                binnumbers=binnumbers, nbin=nbin, gd=gd)
 
 def gen_grid(ds:xarray.Dataset, axes:tuple=('SA', 'sigma0'),
             stat:str='median', bins:dict=None,
-            variable:str='doxy', max_depth:int=None):
+            variable:str='doxy', max_depth:int=None,
+            binning:GridBinning=None, sparse:bool=False):
     """
     Generate a gridded representation of a variable in a dataset.
 
+    See gen_grids() for multiple statistics and variables.
+
     Parameters:
         - ds (xarray.Dataset): The dataset containing the variables.
         - axes (tuple, optional): The axes to use for gridding. Default is ('SA', 'sigma0').
-        - stat (str, optional): The statistic to compute for each grid cell. Default is 'median'.
+        - stat (str, optional): The statistic to compute for each grid cell, e.g. 'mean', 'median', 'std'
+            or a percentile 'pNN' such as 'p90'; see flat_stats(). Default is 'median'.
         - bins (dict, optional): The binning scheme for each axis. Default is None.
         - variable (str, optional): The variable to grid. Default is 'doxy'.
         - max_depth (int, optional): The maximum depth to consider for gridding. Default is None.
+        - binning (GridBinning, optional): Pre-computed binning of ds. Default is None.
+        - sparse (bool, optional): If True, return only the occupied cells. Default is False.
     Returns:
-        - measure: The computed statistic for each grid cell.
+        - measure: The computed statistic for each grid cell.  If sparse, a SparseGrid 
+            holding the statistic in measure.stats[variable][stat].
         - xedges: The bin edges along the x-axis.
         - yedges: The bin edges along the y-axis.
-        - counts: The number of data points in each grid cell.
+        - counts: The number of data points in each grid cell.  If sparse, those of
+            each cell of the SparseGrid.
         - grid_indices: The indices of the grid cells for each data point.
         - doxy_data: The values of the 'doxy' variable for each data point.
         - gd: A boolean mask indicating which data points were used for gridding.
     """
-
-    # Default bins -- Line 90
-    if bins is None:
-        bins = default_bins
-
-    # Cut on good data
-    xkey, ykey = axes
-    
-    gd = np.isfinite(ds[xkey]) & np.isfinite(ds[ykey]) & np.isfinite(ds[variable])
-    if max_depth is not None:
-        depths = np.outer(ds.depth.data, np.ones_like(ds.profile))
-        gd &= depths <= max_depth
-    
-    if variable in ['depth']:
-        var_data = np.outer(ds.depth.data, np.ones_like(ds.profile))
+    binning, gd = binned_points(ds, axes=axes, bins=bins, 
+                                max_depth=max_depth, binning=binning)
+
+    # Restrict to the good values of the variable
+    gd[gd] = np.isfinite(variable_data(ds, variable)[gd])
+    grid_indices = np.array(np.unravel_index(binning.binnumbers(gd), 
+                                             binning.nbin))
+
+    # Grid
+    if sparse:
+        measure = gen_sparse_grid(ds, variables=(variable,), stats=(stat,),
+                                  max_depth=max_depth, binning=binning)
+        counts = measure.stats[variable]['count']
     else:
-        var_data = ds[variable].data
+        items = gen_grids(ds, variables=(variable,), stats=(stat,),
+                          max_depth=max_depth, binning=binning)
+        measure = items['grids'][variable][stat]
+        counts = items['grids'][variable]['count']
+
+    # Return
+    xedges, yedges = binning.edges
+    return measure, xedges, yedges, counts, \
+        grid_indices, ds.doxy.data[gd], gd
 
+class SparseGrid:
+    """ Occupied cells of an N-dimensional grid, in COO form
+
+    Only the cells holding at least one point are stored, 
+    sorted by their flattened index, so a grid with several
+    axes (e.g. SA, sigma0, depth, doy) costs memory in 
+    proportion to the data and not to the number of cells.
+
+    Attributes:
+        axes (tuple): names of the gridding axes
+        edges (list): bin edges along each axis
+        cells (np.ndarray): 0-based bin of each occupied cell 
+            along each axis, shape (naxes, ncell)
+        counts (np.ndarray): number of points in each cell
+        stats (dict): stats[variable][stat] of each cell
+    """
 
-    # Histogram
-    measure, xedges, yedges, grid_indices =\
-            stats.binned_statistic_2d(
-                ds[xkey].data[gd], 
-                ds[ykey].data[gd], 
-                var_data[gd],
-                statistic=stat,
-                bins=[bins[xkey], bins[ykey]],
-                expand_binnumbers=True)
+    def __init__(self, axes:tuple, edges:list, cells:np.ndarray,
+                 counts:np.ndarray, stats:dict=None):
+        self.axes = tuple(axes)
+        self.edges = [np.asarray(iedges, dtype=float) for iedges in edges]
+        self.cells = np.asarray(cells, dtype=np.int64).reshape(len(self.axes), -1)
+        self.counts = np.asarray(counts)
+        self.stats = {} if stats is None else stats
+
+        self.keys = np.ravel_multi_index(self.cells, self.shape)
+
+    @classmethod
+    def from_dense(cls, counts:np.ndarray, edges:list, 
+                   axes:tuple=('SA', 'sigma0'), stats:dict=None):
+        """ Build from a dense grid of counts, e.g. from gen_grid
+
+        Args:
+            counts (np.ndarray): counts on the full grid
+            edges (list): bin edges along each axis
+            axes (tuple, optional): gridding axes. Defaults to ('SA', 'sigma0').
+            stats (dict, optional): dense statistics, stats[variable][stat].
+                Defaults to None.
+
+        Returns:
+            SparseGrid: the cells with non-zero counts
+        """
+        cells = np.array(np.nonzero(counts))
+        index = tuple(cells)
+        sparse_stats = {}
+        if stats is not None:
+            for variable, vstats in stats.items():
+                sparse_stats[variable] = {stat: np.asarray(grid)[index] 
+                                          for stat, grid in vstats.items()}
+        return cls(axes, edges, cells, np.asarray(counts)[index], 
+                   stats=sparse_stats)
+
+    @classmethod
+    def from_dict(cls, items:dict):
+        """ Build from the arrays written by to_dict()
+
+        Args:
+            items (dict): arrays, e.g. of a .npz file
+
+        Returns:
+            SparseGrid: 
+        """
+        axes = tuple([str(key) for key in items['axes']])
+        edges = [items[f'edges_{key}'] for key in axes]
+        stats = {}
+        for key in items.keys():
+            if key.startswith('stat__'):
+                _, variable, stat = key.split('__')
+                stats.setdefault(variable, {})[stat] = items[key]
+        return cls(axes, edges, items['cells'], items['cell_counts'],
+                   stats=stats)
+
+    def to_dict(self):
+        """ Arrays describing the grid, e.g. for np.savez
+
+        Statistics are stored as stat__<variable>__<stat>.
+
+        Returns:
+            dict: 
+        """
+        items = dict(axes=np.array(self.axes), cells=self.cells,
+                     cell_counts=self.counts)
+        for key, iedges in zip(self.axes, self.edges):
+            items[f'edges_{key}'] = iedges
+        for variable, vstats in self.stats.items():
+            for stat, values in vstats.items():
+                if not isinstance(stat, str):
+                    continue
+                items[f'stat__{variable}__{stat}'] = values
+        return items
+
+    def __len__(self):
+        return self.keys.size
+
+    @property
+    def shape(self):
+        """ tuple: Number of bins along each axis """
+        return tuple([len(iedges)-1 for iedges in self.edges])
+
+    def find_cells(self, indices:np.ndarray):
+        """ Cell numbers of a set of grid positions
+
+        Args:
+            indices (np.ndarray): 0-based bin along each axis, 
+                shape (naxes, N)
+
+        Returns:
+            np.ndarray: cell number of each position; -1 if the
+                cell is empty or off the grid
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(len(self.axes), -1)
+        icells = np.full(indices.shape[1], -1, dtype=np.int64)
+        in_grid = np.all((indices >= 0) & 
+                         (indices < np.array(self.shape)[:,None]), axis=0)
+        if len(self) == 0 or not np.any(in_grid):
+            return icells
+        keys = np.ravel_multi_index(indices[:, in_grid], self.shape)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self)-1)
+        icells[in_grid] = np.where(self.keys[pos] == keys, pos, -1)
+        return icells
+
+    def to_dense(self, variable:str=None, stat:str='count'):
+        """ Expand a statistic onto the full grid
+
+        Args:
+            variable (str, optional): variable; None for the counts
+                of the grid. Defaults to None.
+            stat (str, optional): statistic. Defaults to 'count'.
+
+        Returns:
+            np.ndarray: grid with the shape of the bins; empty cells
+                are 0 for count and sum and NaN otherwise
+        """
+        values = self.counts if variable is None else self.stats[variable][stat]
+        fill = 0. if stat in ['count', 'sum'] else np.nan
+        dense = np.full(int(np.prod(self.shape)), fill)
+        dense[self.keys] = values
+        return dense.reshape(self.shape)
+
+
+def gen_sparse_grid(ds:xarray.Dataset, axes:tuple=('SA', 'sigma0', 'depth'),
+                    variables:tuple=('doxy',), stats:tuple=('mean',),
+                    bins:dict=None, max_depth:int=None,
+                    binning:GridBinning=None):
+    """
+    Generate gridded statistics on any number of axes, 
+    keeping only the occupied cells.
 
-    # Counts
-    counts, _, _ = np.histogram2d(
-                ds[xkey].data[gd], 
-                ds[ykey].data[gd], 
-                bins=[bins[xkey], bins[ykey]])
+    Parameters:
+        - ds (xarray.Dataset): The dataset containing the variables.
+        - axes (tuple, optional): The axes to use for gridding, e.g. adding 'depth' 
+            or the day of year 'doy'. Default is ('SA', 'sigma0', 'depth').
+        - variables (tuple, optional): The variables to grid. Default is ('doxy',).
+        - stats (tuple, optional): The statistics to compute for each grid cell;
+            see flat_stats(). Default is ('mean',).
+        - bins (dict, optional): The binning scheme for each axis. Default is None.
+        - max_depth (int, optional): The maximum depth to consider for gridding. Default is None.
+        - binning (GridBinning, optional): Pre-computed binning of ds. Default is None.
+    Returns:
+        SparseGrid: the counts and statistics of the occupied cells.  Points
+            off the grid are not included.
+    """
+    binning, gd = binned_points(ds, axes=axes, bins=bins, 
+                                max_depth=max_depth, binning=binning)
+    shape = tuple([len(iedges)-1 for iedges in binning.edges])
+
+    # Keep the points on the grid
+    ibins = np.array([kbins[gd] for kbins in binning.bins], dtype=np.int64)
+    on_grid = np.all((ibins >= 1) & 
+                     (ibins <= np.array(shape)[:,None]), axis=0)
+    flat = np.ravel_multi_index(ibins[:, on_grid]-1, shape)
+
+    # Occupied cells
+    keys, cell_of, counts = np.unique(flat, return_inverse=True, 
+                                      return_counts=True)
+    cells = np.array(np.unravel_index(keys, shape)).reshape(len(shape), -1)
+
+    # Statistics
+    grid_stats = {}
+    for variable in variables:
+        values = variable_data(ds, variable)[gd][on_grid]
+        ok = np.isfinite(values)
+        grid_stats[variable] = flat_stats(cell_of[ok], values[ok], keys.size,
+                                          stats=('count',) + tuple(stats))
 
     # Return
-    return measure, xedges, yedges, counts, \
-        grid_indices, ds.doxy.data[gd], gd
+    return SparseGrid(binning.axes, binning.edges, cells, counts, 
+                      stats=grid_stats)
+
+def ks_norm_grouped(keys:np.ndarray, values:np.ndarray,
+                    loc:np.ndarray, scale:np.ndarray):
+    """ Two-sided KS test against a normal distribution for each group
+
+    Equivalent to stats.kstest(vals, 'norm', args=(loc, scale))
+    on the values of each group, with all groups evaluated at once 
+    from their sorted segments.
+
+    Args:
+        keys (np.ndarray): group key of each value
+        values (np.ndarray): values
+        loc (np.ndarray): mean of the normal for each value
+        scale (np.ndarray): standard deviation of the normal for each value
+
+    Returns:
+        tuple: unique keys, KS statistic and p-value of each group
+    """
+    # Sort by group then value, carrying the normal along
+    isort = np.lexsort((values, keys))
+    uni_keys, starts, counts = np.unique(keys[isort],
+                                         return_index=True, return_counts=True)
+    cdfvals = stats.norm.cdf(values[isort], np.asarray(loc)[isort], 
+                             np.asarray(scale)[isort])
+
+    # Rank of each value within its group
+    n = np.repeat(counts, counts).astype(float)
+    rank = np.arange(values.size) - np.repeat(starts, counts)
+
+    # D = max(D+, D-) of each segment
+    Dplus = (rank + 1.) / n - cdfvals
+    Dminus = cdfvals - rank / n
+    D = np.maximum(np.maximum.reduceat(Dplus, starts),
+                   np.maximum.reduceat(Dminus, starts)) if values.size > 0 \
+        else np.zeros(0)
+
+    # Exact p-values, as kstest
+    p_values = np.clip(stats.kstwo.sf(D, counts), 0., 1.)
+
+    return uni_keys, D, p_values
 
 def chk_grid_gaussianity(values:np.ndarray, mean_grid:np.ndarray,
                          rms_grid:np.ndarray, indices:np.ndarray,
                          counts:np.ndarray, 
-                         min_counts:int=10):
+                         min_counts:int=10,
+                         cell_index:CellIndex=None):
     """ Evaluate the gaussianity of a grid of values
 
+    All of the cells are tested in one pass; see ks_norm_grouped().
+
     Args:
         values (np.ndarray): Values to check
         mean_grid (np.ndarray): Average values
         rms_grid (np.ndarray): RMS of values
-        indices (np.ndarray): _description_
-        counts (np.ndarray): _description_
-        min_counts (int, optional): _description_. Defaults to 10.
+        indices (np.ndarray): 1-based grid indices of the values, 
+            shape (2, N), as returned by gen_grid
+        counts (np.ndarray): Counts of the grid
+        min_counts (int, optional): Minimum counts of a cell to test it. 
+            Defaults to 10.
+        cell_index (CellIndex, optional): Index of the values by cell.
+            Built from indices if not provided.
 
     Returns:
         np.ndarray: KS test p-values
     """
 
+    if cell_index is None:
+        cell_index = CellIndex.from_grid_indices(indices)
+
     p_values = np.ones_like(mean_grid)*np.nan
+
     # Cut on counts
-    gd = counts > min_counts
-    igd = np.where(gd)
+    nrow, ncol = counts.shape
+    in_grid = (cell_index.cell_rows >= 0) & (cell_index.cell_rows < nrow) & \
+        (cell_index.cell_cols >= 0) & (cell_index.cell_cols < ncol)
+    gd_cell = np.zeros(len(cell_index), dtype=bool)
+    gd_cell[in_grid] = counts[cell_index.cell_rows[in_grid], 
+                              cell_index.cell_cols[in_grid]] > min_counts
+    cell_of = cell_index.cell_of
+    keep = gd_cell[cell_of]
+    cells = cell_of[keep]
+    rows, cols = cell_index.cell_rows[cells], cell_index.cell_cols[cells]
+
+    # KS test
+    uni_cells, _, pvals = ks_norm_grouped(
+        cells, values[keep], mean_grid[rows, cols], rms_grid[rows, cols])
+    p_values[cell_index.cell_rows[uni_cells], 
+             cell_index.cell_cols[uni_cells]] = pvals
 
-    for ss in range(len(igd[0])):
-        row, col = igd[0][ss], igd[1][ss]
+    return p_values
 
-        # Get indices
-        in_cell = (indices[0] == row+1) & (indices[1] == col+1)
-        idx_cell = np.where(in_cell)[0]
+def cell_ks(vals:np.ndarray):
+    """ KS test p-value against a normal with the mean and RMS of the values """
+    return stats.kstest(vals, 'norm', args=(vals.mean(), vals.std())).pvalue
+
+def cell_anderson(vals:np.ndarray):
+    """ Anderson-Darling statistic (A^2) for normality, as stats.anderson """
+    y = np.sort(vals)
+    w = (y - y.mean()) / y.std(ddof=1)
+    n = y.size
+    i = np.arange(1, n+1)
+    return -n - np.sum((2*i - 1.0) / n * (
+        stats.norm.logcdf(w) + stats.norm.logsf(w)[::-1]))
+
+def cell_shapiro(vals:np.ndarray):
+    """ Shapiro-Wilk test p-value;  needs 3 or more values """
+    return stats.shapiro(vals).pvalue if vals.size >= 3 else np.nan
+
+def cell_skew(vals:np.ndarray):
+    """ Skewness of the values """
+    return stats.skew(vals)
+
+def cell_kurtosis(vals:np.ndarray):
+    """ Excess (Fisher) kurtosis of the values """
+    return stats.kurtosis(vals)
+
+# Registry of the per-cell tests of run_cell_tests();
+#  each takes the values of one cell and returns a float.
+#  Add to it with register_cell_test()
+cell_tests = dict(ks=cell_ks, anderson=cell_anderson,
+                  shapiro=cell_shapiro, skew=cell_skew,
+                  kurtosis=cell_kurtosis)
+
+def register_cell_test(name:str, func):
+    """ Add a test to the registry of run_cell_tests()
 
-        # Prep
-        vals = values[idx_cell]
-        mean = mean_grid[row, col]
-        rms = rms_grid[row, col]
+    Args:
+        name (str): name of the test
+        func (callable): takes the values of a cell and returns a float.
+            It must be a module-level function to be sent to 
+            the worker processes.
+    """
+    cell_tests[name] = func
 
-        #if row == 20 and col == 20:
-        #    embed(header='41 chk_grid_gaussianity')
+def cell_table(values:np.ndarray, indices:np.ndarray, metric:str='doxy'):
+    """ Grid table of the gen_grid outputs, for run_cell_tests()
 
-        # KS test
-        r = stats.kstest(vals, 'norm', args=(mean, rms))
-        p_values[row,col] = r.pvalue
+    Args:
+        values (np.ndarray): values of the gridded points
+        indices (np.ndarray): 1-based grid indices, shape (2, N)
+        metric (str, optional): name of the values. Defaults to 'doxy'.
 
-    return p_values
+    Returns:
+        pandas.DataFrame: row, col and metric of each point
+    """
+    return pandas.DataFrame({'row': indices[0]-1, 'col': indices[1]-1,
+                             metric: values})
+
+def _run_cell_chunk(segments:list, funcs:list):
+    """ Run the tests on the values of a chunk of cells
+
+    Args:
+        segments (list): values of each cell
+        funcs (list): tests
+
+    Returns:
+        np.ndarray: results, shape (ncell, ntest)
+    """
+    results = np.full((len(segments), len(funcs)), np.nan)
+    for ss, vals in enumerate(segments):
+        for tt, func in enumerate(funcs):
+            results[ss, tt] = func(vals)
+    return results
+
+def run_cell_tests(grid_tbl:pandas.DataFrame, tests:list=('ks',),
+                   metric:str='doxy', n_workers:int=1, 
+                   min_counts:int=10, shape:tuple=None,
+                   cell_index:CellIndex=None, nchunks:int=None):
+    """ Run a set of statistical tests on the values of each grid cell
+
+    The cells are dealt largest first in a snake order into
+    nchunks chunks of similar total size, which are
+    run on a pool of n_workers processes.
+
+    Args:
+        grid_tbl (pandas.DataFrame): table with row, col and metric
+            columns;  see cell_table() for the outputs of gen_grid
+        tests (list, optional): names of the tests in cell_tests.
+            Defaults to ('ks',).
+        metric (str, optional): column to test. Defaults to 'doxy'.
+        n_workers (int, optional): Number of processes; 1 runs serially.
+            Defaults to 1.
+        min_counts (int, optional): Minimum counts of a cell to test it. 
+            Defaults to 10.
+        shape (tuple, optional): Shape of the grid. Defaults to that of 
+            the SA, sigma0 default_bins.
+        cell_index (CellIndex, optional): Index of the table by cell.
+            Built if not provided.
+        nchunks (int, optional): Number of chunks. Defaults to 4 per worker.
+
+    Raises:
+        IOError: Unknown test or a cell_index that does not match grid_tbl
+
+    Returns:
+        dict: grid of the results of each test;  NaN for cells not tested
+    """
+    for test in tests:
+        if test not in cell_tests:
+            raise IOError(f"Unknown cell test: {test}")
+    funcs = [cell_tests[test] for test in tests]
+
+    cell_index = table_cell_index(grid_tbl, cell_index=cell_index)
+    if shape is None:
+        shape = (default_bins['SA'].size-1, default_bins['sigma0'].size-1)
+
+    # Cells to test
+    counts = cell_index.counts
+    in_grid = (cell_index.cell_rows >= 0) & (cell_index.cell_rows < shape[0]) & \
+        (cell_index.cell_cols >= 0) & (cell_index.cell_cols < shape[1])
+    good = np.where(in_grid & (counts > min_counts))[0]
+
+    # Balanced chunks
+    if nchunks is None:
+        nchunks = 4*n_workers
+    nchunks = max(1, min(nchunks, good.size))
+    order = good[np.argsort(-counts[good], kind='stable')]
+    lane = np.arange(order.size) % (2*nchunks)
+    lane = np.where(lane < nchunks, lane, 2*nchunks-1-lane)
+
+    values = grid_tbl[metric].values
+    chunk_cells, chunks = [], []
+    for kk in range(nchunks):
+        cells = order[lane == kk]
+        chunk_cells.append(cells)
+        chunks.append([values[cell_index.perm[
+            cell_index.offsets[icell]:cell_index.offsets[icell+1]]] 
+                       for icell in cells])
+
+    # Run
+    run_chunk = partial(_run_cell_chunk, funcs=funcs)
+    if n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(run_chunk, chunks))
+    else:
+        results = [run_chunk(chunk) for chunk in chunks]
+
+    # Grids
+    grids = {test: np.full(shape, np.nan) for test in tests}
+    for cells, result in zip(chunk_cells, results):
+        rows, cols = cell_index.cell_rows[cells], cell_index.cell_cols[cells]
+        for tt, test in enumerate(tests):
+            grids[test][rows, cols] = result[:, tt]
 
-def gen_outliers(line:str, pcut:float):
+    return grids
+
+def gen_outliers(line:str, pcut:float, items:dict=None,
+                 pushdown:bool=False):
     """ Generate a table of outliers for a given line
     and percentile
 
@@ -137,6 +1245,12 @@ def gen_outliers(line:str, pcut:float):
         line (str): line
         pcut (float): percentile cut
             Taken as a high extremum if >50 else low
+        items (dict, optional): Output of cugn_io.load_line() 
+            for the line, if already loaded.  If its grid table
+            has been filled in, the outliers are not filled in again.
+        pushdown (bool, optional): If items is not provided, read only
+            the outlier rows of the grid table.  The returned grid_tbl
+            is then None.  Defaults to False.
 
     Raises:
         IOError: _description_
@@ -145,21 +1259,30 @@ def gen_outliers(line:str, pcut:float):
         tuple: grid_outliers, grid_tbl, ds
     """
     
-    # Load and unpack
-    items = cugn_io.load_line(line)
-    ds = items['ds']
-    grid_tbl = items['grid_tbl']
-
     # Outliers
-    if pcut > 50.:
-        outliers = grid_tbl.doxy_p > pcut
+    op = '>' if pcut > 50. else '<'
+
+    # Load and unpack
+    if items is None and pushdown:
+        items = cugn_io.load_line(line, filters=[('doxy_p', op, pcut)])
+        grid_outliers = items['grid_tbl']
+        grid_tbl = None
     else:
-        outliers = grid_tbl.doxy_p < pcut
+        if items is None:
+            items = cugn_io.load_line(line)
+        grid_tbl = items['grid_tbl']
+
+        if pcut > 50.:
+            outliers = grid_tbl.doxy_p > pcut
+        else:
+            outliers = grid_tbl.doxy_p < pcut
 
-    grid_outliers = grid_tbl[outliers].copy()
+        grid_outliers = grid_tbl[outliers].copy()
+    ds = items['ds']
 
     # Fill in grid
-    fill_in_grid(grid_outliers, ds)
+    if not is_filled(grid_outliers):
+        fill_in_grid(grid_outliers, ds)
 
     # Return
     return grid_outliers, grid_tbl, ds
@@ -168,75 +1291,325 @@ def fill_in_grid(grid, ds):
     """
     Fills in the grid with data from the given dataset.
 
+    Only the (depth, profile) points of the grid are read, so 
+    a lazily loaded dataset (see cugn_io.load_line) is not
+    pulled into memory.  Quantities missing from the dataset
+    are skipped.
+
     Parameters:
         grid (pandas.DataFrame): The grid to be filled in.
         ds (xarray.Dataset): The dataset containing the data.
 
     """
+    depth, profile = grid.depth.values, grid.profile.values
 
     # Decorate items
-    grid['time'] = pandas.to_datetime(ds.time[grid.profile.values].values)
-    grid['lon'] = ds.lon[grid.profile.values].values
-    grid['lat'] = ds.lat[grid.profile.values].values
-    grid['z'] = ds.depth[grid.depth.values].values
+    grid['time'] = pandas.to_datetime(ds.time[profile].values)
+    grid['lon'] = ds.lon[profile].values
+    grid['lat'] = ds.lat[profile].values
+    grid['z'] = ds.depth[depth].values
+
+    # Physical quantities, buoyancy and others
+    for key, dskey in [('CT', 'CT'), ('SA', 'SA'), ('sigma0', 'sigma0'),
+                       ('SO', 'SO'), ('N', 'N'), 
+                       ('chla', 'chlorophyll_a'), ('T', 'temperature')]:
+        if dskey in ds:
+            grid[key] = grab_points(ds[dskey], depth, profile)
+
+
+def grab_points(da:xarray.DataArray, depth:np.ndarray, 
+                profile:np.ndarray):
+    """
+    Values of a (depth, profile) variable at a set of points.
+
+    Parameters:
+        da (xarray.DataArray): The variable
+        depth (np.ndarray): depth index of each point
+        profile (np.ndarray): profile index of each point
+
+    Returns:
+        np.ndarray: The values
+    """
+    da = da.transpose('depth', 'profile')
+    if da.chunks is None:
+        return da.data[(depth, profile)]
+    # Dask; only the chunks holding the points are read
+    return da.data.vindex[(depth, profile)].compute()
+
+
+def is_filled(grid:pandas.DataFrame):
+    """
+    Check whether fill_in_grid() has been run on a grid.
+
+    Parameters:
+        grid (pandas.DataFrame): The grid.
+
+    Returns:
+        bool: True if filled
+    """
+    return all([key in grid.columns for key in ['time', 'z', 'SO', 'N']])
 
-    # Physical quantities
-    grid['CT'] = ds.CT.data[(grid.depth.values, grid.profile.values)]
-    grid['SA'] = ds.SA.data[(grid.depth.values, grid.profile.values)]
-    grid['sigma0'] = ds.sigma0.data[(grid.depth.values, grid.profile.values)]
-    grid['SO'] = ds.SO.data[(grid.depth.values, grid.profile.values)]
-    # Buyoancy                            
-    grid['N'] = ds.N.data[(grid.depth.values, grid.profile.values)]
 
+def _control_slots(outliers:pandas.DataFrame, cell_index:CellIndex,
+                   boost:int=10):
+    """ Where each control value is to be drawn from
 
-    # Others                            
-    grid['chla'] = ds.chlorophyll_a.data[(grid.depth.values, grid.profile.values)]
-    grid['T'] = ds.temperature.data[(grid.depth.values, grid.profile.values)]
+    Outlier cells without any control entries are skipped,
+    with a warning, as they cannot be matched.
 
+    Args:
+        outliers (pandas.DataFrame): Table of outliers of interest
+        cell_index (CellIndex): Index of the control table by cell
+        boost (int, optional): Number of control values
+            to grab per outlier. Defaults to 10.
+
+    Returns:
+        tuple: start in cell_index.perm and size of the cell
+            of each control value, ordered by cell
+    """
+    # Outliers per cell, in one grouped count
+    comb_row_col = pack_rowcol(outliers.row.values, outliers.col.values)
+    uni_rc, uni_No = np.unique(comb_row_col, return_counts=True)
+
+    # Matching cells of the control
+    icell = np.searchsorted(cell_index.keys, uni_rc)
+    icell = np.minimum(icell, max(len(cell_index)-1, 0))
+    found = (cell_index.keys[icell] == uni_rc) if len(cell_index) > 0 \
+        else np.zeros(uni_rc.size, dtype=bool)
+    if not np.all(found):
+        warnings.warn(f"Skipping {np.sum(~found)} of {found.size} outlier cells "
+                      f"({np.sum(uni_No[~found])} outliers) with no control values")
+    icell, uni_No = icell[found], uni_No[found]
+
+    # One slot per value to grab
+    Ngrab = boost * uni_No
+    starts = np.repeat(cell_index.offsets[icell], Ngrab)
+    sizes = np.repeat(cell_index.counts[icell], Ngrab)
+
+    return starts, sizes
 
 def grab_control_values(outliers:pandas.DataFrame,
                         grid_tbl:pandas.DataFrame,
                         metric:str,
-                        boost:int=10):
+                        boost:int=10,
+                        cell_index:CellIndex=None,
+                        rng=None):
     """ Grab the values of a given metric for the control
 
+    boost values are drawn at random, with repeats, from the
+    cell of each outlier.  All of the draws are made at once.
+
     Args:
         outliers (pandas.DataFrame): Table of outliers of interest
         grid_tbl (pandas.DataFrame): Full table of values
         metric (str): stat to generate control values for
+        boost (int, optional): Number of control values
+            to grab per outlier. Defaults to 10.
+        cell_index (CellIndex, optional): Index of grid_tbl by cell.
+            Built from grid_tbl if not provided.
+        rng (np.random.Generator or int, optional): Random generator 
+            or seed, for reproducible draws. Defaults to None, which
+            draws from the global np.random state so np.random.seed()
+            still applies.
 
     Returns:
-        np.array: Control values for the outliers presented
+        np.array: Control values for the outliers presented, grouped by cell.
+            Cells of the outliers that are not in grid_tbl are skipped
+            with a warning.
     """
 
-    comb_row_col = np.array([col*10000 + row for row,col in zip(outliers.row.values, 
-                                                                outliers.col.values)])
-    uni_rc = np.unique(comb_row_col)
-    uni_col = uni_rc // 10000
-    uni_row = uni_rc - uni_col*10000
+    cell_index = table_cell_index(grid_tbl, cell_index=cell_index)
 
-    all_vals = []
-    for row, col in zip(uni_row, uni_col):
-        in_cell = (grid_tbl.row == row) & (grid_tbl.col == col)
+    # Random with repeats
+    starts, sizes = _control_slots(outliers, cell_index, boost=boost)
+    if rng is None:
+        offsets = np.random.randint(0, sizes)
+    else:
+        offsets = np.random.default_rng(rng).integers(0, sizes)
+    idx = cell_index.perm[starts + offsets]
 
-        # Count
-        Ncell = np.sum(in_cell)
-        No = np.sum((outliers.row == row) & (outliers.col == col))
-        Ngrab = boost * No
+    # Return
+    return grid_tbl[metric].values[idx]
 
-        # Random with repeats
-        ridx = np.random.choice(np.arange(Ncell), size=Ngrab)
-        idx = np.where(in_cell)[0][ridx]
 
-        # Grab em
-        vals = grid_tbl[metric].values[idx]
+def _bootstrap_batch(task:tuple, cell_values:np.ndarray, 
+                     starts:np.ndarray, sizes:np.ndarray,
+                     x:np.ndarray, xq:np.ndarray):
+    """ Statistics of one batch of bootstrap control samples
 
-        # Save
-        all_vals += vals.tolist()
+    Args:
+        task (tuple): seed (np.random.SeedSequence) and number of replicates
+        cell_values (np.ndarray): control values, sorted by cell
+        starts (np.ndarray): start of the cell of each control slot
+        sizes (np.ndarray): size of the cell of each control slot
+        x (np.ndarray): sorted outlier values
+        xq (np.ndarray): values at which to evaluate the control CDFs
+
+    Returns:
+        tuple: median, CDF at xq and KS distance of each replicate
+    """
+    seed, nrep = task
+    rng = np.random.default_rng(seed)
+
+    # B x Ngrab matrix of draws
+    idx = starts + rng.integers(0, sizes, size=(nrep, sizes.size))
+    ctrl = np.sort(cell_values[idx], axis=1)
+    del idx
+
+    # Median
+    medians = np.median(ctrl, axis=1)
+
+    # CDF at the quantiles of the outliers
+    cdfs = np.stack([(ctrl <= ixq).mean(axis=1) for ixq in xq], axis=1)
+
+    # KS distance, as stats.ks_2samp, from a merged sort of each row
+    n1, n2 = x.size, sizes.size
+    both = np.concatenate([ctrl, np.broadcast_to(x, (nrep, n1))], axis=1)
+    del ctrl
+    order = np.argsort(both, axis=1, kind='stable')
+    sboth = np.take_along_axis(both, order, axis=1)
+    is_ctrl = order < n2
+    del both, order
+    cdf1 = np.cumsum(~is_ctrl, axis=1) / n1
+    cdf2 = np.cumsum(is_ctrl, axis=1) / n2
+    # Evaluate at the last of any tied values
+    last = np.ones_like(is_ctrl)
+    last[:, :-1] = sboth[:, 1:] != sboth[:, :-1]
+    ks = np.max(np.where(last, np.abs(cdf1 - cdf2), 0.), axis=1)
+
+    return medians, cdfs, ks
+
+def bootstrap_control(outliers:pandas.DataFrame,
+                      grid_tbl:pandas.DataFrame,
+                      metric:str, boost:int=10, nboot:int=1000,
+                      quantiles:tuple=(0.1, 0.25, 0.5, 0.75, 0.9),
+                      rng=None, n_workers:int=1,
+                      max_mb:float=256., 
+                      cell_index:CellIndex=None):
+    """ Bootstrap the comparison of the outliers to matched-cell controls
+
+    Each replicate is a grab_control_values() draw.  The replicates 
+    are drawn in batches as a B x Ngrab matrix of indices into the 
+    cell-sorted table, with B set so a batch uses about max_mb of memory.
+    The batches have their own random streams, so the results 
+    depend on rng but not on n_workers.
+
+    Args:
+        outliers (pandas.DataFrame): Table of outliers of interest
+        grid_tbl (pandas.DataFrame): Full table of values
+        metric (str): stat to compare
+        boost (int, optional): Number of control values
+            to grab per outlier. Defaults to 10.
+        nboot (int, optional): Number of replicates. Defaults to 1000.
+        quantiles (tuple, optional): Quantiles of the outliers at which
+            to evaluate the control CDFs. Defaults to (0.1, 0.25, 0.5, 0.75, 0.9).
+        rng (np.random.Generator or int, optional): Random generator 
+            or seed. Defaults to None, which seeds the batches from the
+            global np.random state.
+        n_workers (int, optional): Number of processes; 1 runs serially.
+            Defaults to 1.
+        max_mb (float, optional): Approximate memory of one batch (MB).
+            Defaults to 256.
+        cell_index (CellIndex, optional): Index of grid_tbl by cell.
+            Built from grid_tbl if not provided.
+
+    Returns:
+        dict: 
+        - median: median of each replicate
+        - cdf: control CDF at xq of each replicate, shape (nboot, nquantiles)
+        - ks: KS distance between the outliers and each replicate
+        - quantiles, xq: the quantiles and their values for the outliers
+        - outlier_median: median of the outliers
+        Non-finite outlier values are ignored.
+    """
+    cell_index = table_cell_index(grid_tbl, cell_index=cell_index)
+
+    # Control slots and values
+    starts, sizes = _control_slots(outliers, cell_index, boost=boost)
+    if sizes.size == 0:
+        raise IOError("None of the outlier cells are in grid_tbl")
+    cell_values = grid_tbl[metric].values[cell_index.perm]
+
+    # Outliers
+    x = np.asarray(outliers[metric].values, dtype=float)
+    x = np.sort(x[np.isfinite(x)])
+    quantiles = np.atleast_1d(quantiles)
+    xq = np.quantile(x, quantiles)
+
+    # Batches, bounded in memory (~5 arrays of 8 bytes per entry)
+    batch = int(max(1, max_mb * 2**20 // (40 * (sizes.size + x.size))))
+    nreps = [min(batch, nboot - ii) for ii in range(0, nboot, batch)]
+    if rng is None:
+        seed = np.random.randint(0, 2**63-1, dtype=np.int64)
+    else:
+        seed = np.random.default_rng(rng).integers(0, 2**63)
+    seeds = np.random.SeedSequence(int(seed)).spawn(len(nreps))
+    tasks = list(zip(seeds, nreps))
+
+    run_batch = partial(_bootstrap_batch, cell_values=cell_values,
+                        starts=starts, sizes=sizes, x=x, xq=xq)
+    if n_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(run_batch, tasks))
+    else:
+        results = [run_batch(task) for task in tasks]
 
     # Return
-    return np.array(all_vals)
+    return dict(median=np.concatenate([r[0] for r in results]),
+                cdf=np.concatenate([r[1] for r in results]),
+                ks=np.concatenate([r[2] for r in results]),
+                quantiles=quantiles, xq=xq, 
+                outlier_median=np.median(x))
+
+
+def old_chk_grid_gaussianity(values:np.ndarray, mean_grid:np.ndarray,
+                         rms_grid:np.ndarray, indices:np.ndarray,
+                         counts:np.ndarray, 
+                         min_counts:int=10,
+                         cell_index:CellIndex=None):
+    """ Evaluate the gaussianity of a grid of values
+
+    Args:
+        values (np.ndarray): Values to check
+        mean_grid (np.ndarray): Average values
+        rms_grid (np.ndarray): RMS of values
+        indices (np.ndarray): _description_
+        counts (np.ndarray): _description_
+        min_counts (int, optional): _description_. Defaults to 10.
+        cell_index (CellIndex, optional): Index of the values by cell.
+            Built from indices if not provided.
+
+    Returns:
+        np.ndarray: KS test p-values
+    """
+
+    if cell_index is None:
+        cell_index = CellIndex.from_grid_indices(indices)
+
+    p_values = np.ones_like(mean_grid)*np.nan
+    # Cut on counts
+    gd = counts > min_counts
+    igd = np.where(gd)
+
+    for ss in range(len(igd[0])):
+        row, col = igd[0][ss], igd[1][ss]
+
+        # Get indices
+        idx_cell = cell_index.lookup(row, col)
+
+        # Prep
+        vals = values[idx_cell]
+        mean = mean_grid[row, col]
+        rms = rms_grid[row, col]
+
+        #if row == 20 and col == 20:
+        #    embed(header='41 chk_grid_gaussianity')
+
+        # KS test
+        r = stats.kstest(vals, 'norm', args=(mean, rms))
+        p_values[row,col] = r.pvalue
 
+    return p_values
 
 def old_grab_control_values(outliers:pandas.DataFrame,
                         grid_tbl:pandas.DataFrame,
@@ -293,38 +1666,45 @@ def old_grab_control_values(outliers:pandas.DataFrame,
     # Return
     return final_vals
 
-def find_perc(grid_tbl:pandas.DataFrame, metric:str='doxy'):
+def find_perc(grid_tbl:pandas.DataFrame, metric:str|list='doxy',
+              cell_index:CellIndex=None):
     """ Find the percentile of the values in each cell
 
+    All cells are handled in a single pass: the rows are
+    grouped once by their packed (row, col) key and each
+    metric is then ranked within its cell with one lexsort.
+
     Args:
-        grid_tbl (pandas.DataFrame): _description_
-        metric (str, optional): _description_. Defaults to 'doxy'.
+        grid_tbl (pandas.DataFrame): Table of values with row, col columns
+            Modified in place with a {metric}_p column for each metric
+        metric (str or list, optional): metric(s) to find the percentiles
+            for. Defaults to 'doxy'.
+        cell_index (CellIndex, optional): Index of grid_tbl by cell.
+            Built from grid_tbl if not provided.
     """
+    metrics = [metric] if isinstance(metric, str) else list(metric)
 
-    # Find unique to loop over
-    comb_row_col = np.array([col*10000 + row for row,col in zip(grid_tbl.row.values, grid_tbl.col.values)])
-    uni_rc = np.unique(comb_row_col)
-    uni_col = uni_rc // 10000
-    uni_row = uni_rc - uni_col*10000
-
-    all_perc = np.zeros(len(grid_tbl))
-
-    for row, col in zip(uni_row, uni_col):
-        # Get indices
-        in_cell = (grid_tbl.row == row) & (grid_tbl.col == col)
+    # Group the rows by cell (once)
+    cell_index = table_cell_index(grid_tbl, cell_index=cell_index)
+    cell_id = cell_index.cell_of
+    cell_counts = cell_index.counts
+    cell_start = cell_index.offsets[:-1]
 
-        # Values in the cell
-        vals = grid_tbl[metric].values[in_cell]
+    for imetric in metrics:
+        # Sort by cell and then by value within the cell
+        srt = np.lexsort((grid_tbl[imetric].values, cell_id))
+        srt_id = cell_id[srt]
 
-        srt = np.argsort(vals)
-        in_srt = cat_utils.match_ids(np.arange(len(vals)), srt)
-        perc = np.arange(len(vals))/len(vals-1)*100.
+        # Rank within the cell
+        rank = np.arange(len(srt)) - cell_start[srt_id]
+        perc = rank / cell_counts[srt_id] * 100.
 
         # Save
-        all_perc[in_cell] = perc[in_srt]
+        all_perc = np.zeros(len(grid_tbl))
+        all_perc[srt] = perc
+        grid_tbl[f'{imetric}_p'] = all_perc
 
     # Return
-    grid_tbl[f'{metric}_p'] = all_perc
     return 
 
 
@@ -372,7 +1752,8 @@ def old_find_outliers(values:np.ndarray,
                   grid_indices:np.ndarray,
                   counts:np.ndarray, percentile:float,
                   da_gd:np.ndarray,
-                  min_counts:int=50):
+                  min_counts:int=50,
+                  cell_index:CellIndex=None):
     """ Find outliers in a grid of values
 
     Args:
@@ -383,6 +1764,8 @@ def old_find_outliers(values:np.ndarray,
         da_gd (np.ndarray): Used for indexing in ds space
         min_counts (int, optional): Minimum counts in the grid
           to perform analysis. Defaults to 50.
+        cell_index (CellIndex, optional): Index of the values by cell.
+            Built from grid_indices if not provided.
 
     Returns:
         tuple:
@@ -393,6 +1776,9 @@ def old_find_outliers(values:np.ndarray,
     # upper or lower?
     high = True if percentile > 50 else False
 
+    if cell_index is None:
+        cell_index = CellIndex.from_grid_indices(grid_indices)
+
     # Cut on counts
     gd = counts > min_counts
     igd = np.where(gd)
@@ -412,8 +1798,7 @@ def old_find_outliers(values:np.ndarray,
         row, col = igd[0][ss], igd[1][ss]
 
         # Get indices
-        in_cell = (grid_indices[0] == row+1) & (grid_indices[1] == col+1)
-        idx_cell = np.where(in_cell)[0]
+        idx_cell = cell_index.lookup(row, col)
 
         # Percentile
         vals = values[idx_cell]
@@ -1,5 +1,8 @@
 """ I/O for CUGN data and analysis """
 import os
+import glob
+from collections import OrderedDict
+
 import numpy as np
 import xarray
 import pandas
@@ -12,6 +15,10 @@ from IPython import embed
 
 data_path = os.getenv('CUGN')
 
+# Session cache of the files read by load_line()
+cache_size = 8
+_cache = OrderedDict()
+
 def line_files(line:str):
     """
     Generate a dictionary of file paths based on the given line.
@@ -20,7 +27,9 @@ def line_files(line:str):
         line (str): The line number.
 
     Returns:
-        dict: A dictionary containing the file paths for the datafile, gridtbl_file_full, gridtbl_file_control, and edges_file.
+        dict: A dictionary containing the file paths for the datafile, gridtbl_file_full, gridtbl_file_control, edges_file,
+            the grid binning of the datafile, the cell index files of the two grid tables, and those of the Zarr backend
+            (datastore, gridtbl_dir_full, gridtbl_dir_control); see convert_to_zarr().
     """
 
 
@@ -28,25 +37,209 @@ def line_files(line:str):
     gridtbl_file_full = os.path.join(data_path, f'full_grid_line{line[0:2]}.parquet')
     gridtbl_file_control = os.path.join(data_path, f'doxy_grid_line{line[0:2]}.parquet')
     edges_file = os.path.join(data_path, f'doxy_edges_line{line[0:2]}.npz')
+    # Zarr backend
+    datastore = os.path.join(data_path, f'CUGN_potential_line_{line[0:2]}.zarr')
+    gridtbl_dir_full = os.path.join(data_path, f'full_grid_line{line[0:2]}_parts')
+    gridtbl_dir_control = os.path.join(data_path, f'doxy_grid_line{line[0:2]}_parts')
 
     # dict em
     lfiles = dict(datafile=datafile, 
                   gridtbl_file_full=gridtbl_file_full, 
                   gridtbl_file_control=gridtbl_file_control, 
-                  edges_file=edges_file)
+                  edges_file=edges_file,
+                  binning_file=binning_file(datafile),
+                  cellidx_file_full=cellidx_file(gridtbl_file_full),
+                  cellidx_file_control=cellidx_file(gridtbl_file_control),
+                  datastore=datastore,
+                  gridtbl_dir_full=gridtbl_dir_full,
+                  gridtbl_dir_control=gridtbl_dir_control)
     # Return
     return lfiles
-    
-def load_line(line:str, use_full:bool=False):
+
+def cellidx_file(gridtbl_file:str):
+    """
+    Name of the cell index file written next to a grid table.
+
+    Parameters:
+        gridtbl_file (str): The grid table file (.parquet).
+
+    Returns:
+        str: The cell index file (.npz).
+    """
+    return gridtbl_file.replace('.parquet', '_cells.npz')
+
+def binning_file(datafile:str):
+    """
+    Name of the grid binning file written next to a potential file.
+
+    Parameters:
+        datafile (str): The potential file (.nc).
+
+    Returns:
+        str: The binning file (.npz).
+    """
+    return datafile.replace('.nc', '_binning.npz')
+
+def clear_cache():
+    """
+    Empty the session cache of load_line().
+    """
+    _cache.clear()
+
+def _load_cached(filename:str, loader, use_cache:bool=True, tag=None):
+    """
+    Load a file, keeping the result in the session cache.
+
+    Entries are keyed by the file name and its modification time, 
+    so a rewritten file is read again.  The cache holds at most
+    cache_size entries, dropping the least recently used.
+
+    Parameters:
+        filename (str): The file to load.
+        loader (callable): Function reading the file.
+        use_cache (bool, optional): Whether to use the cache. Defaults to True.
+        tag (hashable, optional): Distinguishes different loaders of the same file. 
+            Defaults to None.
+
+    Returns:
+        object: The output of loader(filename).
+    """
+    if not use_cache or cache_size <= 0:
+        print(f"Loading: {os.path.basename(filename)}")
+        return loader(filename)
+
+    key = (filename, os.path.getmtime(filename), tag)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    # Drop stale versions of the file
+    for old_key in [ikey for ikey in _cache 
+                    if ikey[0] == filename and ikey[2] == tag]:
+        del _cache[old_key]
+
+    print(f"Loading: {os.path.basename(filename)}")
+    _cache[key] = loader(filename)
+    while len(_cache) > cache_size:
+        _cache.popitem(last=False)
+
+    return _cache[key]
+
+def _hashable(obj):
+    """ Convert (nested) lists to tuples for use in a cache key """
+    if isinstance(obj, (list, tuple)):
+        return tuple([_hashable(item) for item in obj])
+    return obj
+
+def _load_variables(filename:str, variables:list=None, engine:str=None):
+    """ Read the given variables (default all) of a dataset """
+    with xarray.open_dataset(filename, engine=engine) as ds:
+        if variables is not None:
+            ds = ds[variables]
+        return ds.load()
+
+def _load_npz(filename:str):
+    """ Read all of the arrays of a .npz file into a dict """
+    with np.load(filename) as f:
+        return dict(f)
+
+def write_edges(outfile:str, SA_edges:np.ndarray, sigma_edges:np.ndarray,
+                counts, sparse:bool=False):
+    """
+    Write the grid edges and counts of a line.
+
+    Parameters:
+        outfile (str): The edges file (.npz).
+        SA_edges (np.ndarray): The SA bin edges.
+        sigma_edges (np.ndarray): The sigma0 bin edges.
+        counts (np.ndarray or grid_utils.SparseGrid): The counts of the grid.
+        sparse (bool, optional): If True, store only the occupied cells (COO).
+            A SparseGrid is always stored this way. Defaults to False.
+    """
+    if isinstance(counts, grid_utils.SparseGrid):
+        sparse = True
+    elif sparse:
+        counts = grid_utils.SparseGrid.from_dense(
+            counts, [SA_edges, sigma_edges])
+
+    if sparse:
+        items = counts.to_dict()
+        np.savez(outfile, SA_edges=SA_edges, sigma_edges=sigma_edges,
+                 shape=np.array(counts.shape), **items)
+    else:
+        np.savez(outfile, SA_edges=SA_edges, sigma_edges=sigma_edges,
+                 counts=counts)
+
+def load_edges(filename:str, dense:bool=True):
+    """
+    Read an edges file written by write_edges().
+
+    Parameters:
+        filename (str): The edges file (.npz).
+        dense (bool, optional): If True, expand sparse counts onto the full grid.
+            Defaults to True.
+
+    Returns:
+        dict: SA_edges, sigma_edges and counts;  a sparse file also 
+            provides the SparseGrid as grid, and counts is only 
+            included if dense.
+    """
+    items = _load_npz(filename)
+    if 'cells' not in items:
+        return items
+
+    grid = grid_utils.SparseGrid.from_dict(items)
+    edges = dict(SA_edges=items['SA_edges'], sigma_edges=items['sigma_edges'],
+                 grid=grid)
+    if dense:
+        edges['counts'] = grid.to_dense()
+    return edges
+
+def load_line(line:str, use_full:bool=False, use_cache:bool=True,
+              lazy:bool=False, variables:list=None, 
+              chunk_size:int=1000, columns:list=None,
+              filters:list=None, backend:str='netcdf'):
     """
     Load data from files associated with a given line.
 
+    The files are kept in a session cache (see _load_cached) so 
+    repeated calls do not read the disk again.  Each call returns 
+    its own copy of the grid table and a shallow copy of the dataset;
+    the data arrays of the dataset are shared and should not be 
+    modified in place.
+
+    With lazy=True the dataset is opened with dask chunks of 
+    chunk_size profiles and nothing is read until it is used 
+    (e.g. by grid_utils.fill_in_grid, which only reads the 
+    points it indexes).  Lazy datasets are not cached.
+
+    The columns and filters of the grid table are pushed down to 
+    pyarrow so only the requested columns and rows are read, 
+    e.g. filters=[('depth', '<=', 5), ('doxy_p', '>', 90.)]
+    The saved cell index is not returned for a filtered table.
+
+    With backend='zarr' the dataset is read from the Zarr store
+    and the grid table from the directory of parquet parts
+    written by convert_to_zarr().
+
     Parameters:
         line (str): The line to load data for.
         use_full (bool, optional): Whether to use the full grid table file or the control grid table file. Defaults to False.
+        use_cache (bool, optional): Whether to use the session cache. Defaults to True.
+        lazy (bool, optional): Whether to open the dataset lazily. Requires dask. Defaults to False.
+        variables (list, optional): Variables of the dataset to keep; time, lon and lat are always kept.
+            Defaults to None (all).
+        chunk_size (int, optional): Number of profiles per chunk when lazy; 
+            Zarr stores use their own chunks. Defaults to 1000.
+        columns (list, optional): Columns of the grid table to read. Defaults to None (all).
+        filters (list, optional): Row filters of the grid table, in the pyarrow
+            format of pandas.read_parquet. Defaults to None.
+        backend (str, optional): 'netcdf' or 'zarr'. Defaults to 'netcdf'.
 
     Returns:
-        dict: A dictionary containing the loaded data, including the dataset, grid table, and edges.
+        dict: A dictionary containing the loaded data, including the dataset, grid table, edges,
+            and the cell index of the grid table (None if it has not been built
+            or does not match the table).
     """
     # Files
     lfiles = line_files(line)
@@ -56,20 +249,118 @@ def load_line(line:str, use_full:bool=False):
         grid_file = lfiles['gridtbl_file_full']
     else:   
         grid_file = lfiles['gridtbl_file_control']
-    print(f"Loading: {os.path.basename(grid_file)}")
-    grid_tbl = pandas.read_parquet(grid_file)
-    ds = xarray.load_dataset(lfiles['datafile'])
-    edges = np.load(lfiles['edges_file'])
 
+    # Backend
+    if backend == 'netcdf':
+        datafile = lfiles['datafile']
+        engine = None
+        grid_path = grid_file
+    elif backend == 'zarr':
+        datafile = lfiles['datastore']
+        engine = 'zarr'
+        grid_path = lfiles['gridtbl_dir_full'] if use_full else lfiles['gridtbl_dir_control']
+    else:
+        raise IOError(f"Bad backend: {backend}")
+
+    if columns is None and filters is None:
+        grid_tbl = _load_cached(grid_path, pandas.read_parquet, 
+                                use_cache=use_cache).copy()
+    else:
+        grid_tbl = _load_cached(grid_path, 
+            lambda filename: pandas.read_parquet(
+                filename, columns=columns, filters=filters),
+            use_cache=use_cache, 
+            tag=_hashable((columns, filters))).copy()
+
+    # Dataset
+    if variables is not None:
+        variables = list(variables) + [key for key in ['time', 'lon', 'lat'] 
+                                       if key not in variables]
+    if lazy:
+        # Zarr stores are read in their own chunks
+        chunks = {} if backend == 'zarr' else {'profile': chunk_size}
+        ds = xarray.open_dataset(datafile, engine=engine, chunks=chunks)
+        if variables is not None:
+            ds = ds[variables]
+    else:
+        ds = _load_cached(datafile, 
+            lambda filename: _load_variables(filename, variables, engine=engine),
+            use_cache=use_cache, 
+            tag=None if variables is None else tuple(variables)).copy(deep=False)
+    edges = _load_cached(lfiles['edges_file'], load_edges,
+                         use_cache=use_cache)
+
+    # Cell index
+    cell_file = cellidx_file(grid_file)
+    if os.path.isfile(cell_file) and filters is None:
+        cell_index = _load_cached(cell_file, grid_utils.CellIndex.load,
+                                  use_cache=use_cache)
+        # Stale?  Callers then rebuild it with CellIndex.from_table()
+        if not cell_index.matches(grid_tbl):
+            print(f"Ignoring {os.path.basename(cell_file)}: it does not match the grid table")
+            cell_index = None
+    else:
+        cell_index = None
 
     # dict em
-    items = dict(ds=ds, grid_tbl=grid_tbl, edges=edges)
+    items = dict(ds=ds, grid_tbl=grid_tbl, edges=edges,
+                 cell_index=cell_index)
 
     return items
 
 
 
-def load_up(line:str, gextrem:str='high', use_full:bool=False):
+def convert_to_zarr(line:str, chunk_size:int=1000, 
+                    rows_per_file:int=1000000):
+    """
+    Convert the files of a line to the Zarr backend of load_line().
+
+    The dataset is written to a Zarr store chunked by profile 
+    (all depths of chunk_size profiles per chunk) and each grid 
+    table to a directory of parquet parts of rows_per_file rows,
+    keeping the row order so the cell index files still apply.
+    Requires zarr.
+
+    Parameters:
+        line (str): The line to convert.
+        chunk_size (int, optional): Number of profiles per Zarr chunk. Defaults to 1000.
+        rows_per_file (int, optional): Number of rows per parquet part. Defaults to 1000000.
+    """
+    lfiles = line_files(line)
+
+    # Dataset
+    ds = xarray.load_dataset(lfiles['datafile'])
+    encoding = {}
+    for key in ds.variables:
+        ds[key].encoding = {}
+        if 'profile' in ds[key].dims:
+            encoding[key] = dict(chunks=tuple(
+                [min(chunk_size, size) if dim == 'profile' else size 
+                 for dim, size in zip(ds[key].dims, ds[key].shape)]))
+    ds.to_zarr(lfiles['datastore'], mode='w', encoding=encoding)
+    print(f"Wrote: {lfiles['datastore']}")
+
+    # Grid tables
+    for grid_file, grid_dir in zip(
+        [lfiles['gridtbl_file_full'], lfiles['gridtbl_file_control']],
+        [lfiles['gridtbl_dir_full'], lfiles['gridtbl_dir_control']]):
+        if not os.path.isfile(grid_file):
+            continue
+        grid_tbl = pandas.read_parquet(grid_file)
+        # Start fresh
+        if os.path.isdir(grid_dir):
+            for part in glob.glob(os.path.join(grid_dir, 'part-*.parquet')):
+                os.remove(part)
+        else:
+            os.makedirs(grid_dir)
+        for ipart, start in enumerate(range(0, max(len(grid_tbl), 1), rows_per_file)):
+            grid_tbl.iloc[start:start+rows_per_file].to_parquet(
+                os.path.join(grid_dir, f'part-{ipart:04d}.parquet'), index=False)
+        print(f"Wrote: {grid_dir}")
+
+
+def load_up(line:str, gextrem:str='high', use_full:bool=False,
+            columns:list=None, filters:list=None):
     """
     Load data and perform various operations on it.
 
@@ -77,6 +368,10 @@ def load_up(line:str, gextrem:str='high', use_full:bool=False):
         line (str): The line to load data for.
         gextrem (str, optional): The type of extremum to consider. Defaults to 'high'.
         use_full (bool, optional): Whether to use the full data or not. Defaults to False.
+        columns (list, optional): Columns of the grid table to read; must include
+            depth, profile, row, col and doxy_p. Defaults to None (all).
+        filters (list, optional): Row filters of the grid table; see load_line. 
+            Defaults to None.
 
     Returns:
         tuple: A tuple containing the following:
@@ -86,7 +381,8 @@ def load_up(line:str, gextrem:str='high', use_full:bool=False):
             - grid_tbl (pandas.DataFrame): DataFrame containing the loaded data.
     """
     # Load
-    items = load_line(line, use_full=use_full)
+    items = load_line(line, use_full=use_full, columns=columns,
+                      filters=filters)
     grid_tbl = items['grid_tbl']
     ds = items['ds']
 
@@ -104,7 +400,13 @@ def load_up(line:str, gextrem:str='high', use_full:bool=False):
         perc = 50.
     else:
         raise IOError("Bad gextrem input")
-    grid_outliers, tmp, _ = grid_utils.gen_outliers(line, perc)
+    if use_full:
+        # Outliers are defined on the control grid
+        grid_outliers, tmp, _ = grid_utils.gen_outliers(line, perc, 
+                                                        pushdown=True)
+    else:
+        grid_outliers, tmp, _ = grid_utils.gen_outliers(line, perc,
+                                                        items=items)
 
     if gextrem == 'high':
         extrem = grid_outliers.SO > 1.1
@@ -131,13 +433,14 @@ def load_up(line:str, gextrem:str='high', use_full:bool=False):
     #ttimes = pandas.to_datetime(grid_tbl.time.values)
     #in_t = (ttimes >= tmin) & (ttimes <= tmax) & (grid_tbl.depth <= 1)
 
-    # Fill in N_p, chla_p
-    grid_utils.find_perc(grid_tbl, 'N')
-    grid_utils.find_perc(grid_tbl, 'chla')
+    # Fill in N_p, chla_p;  the table keeps the row order of its cell index
+    grid_utils.find_perc(grid_tbl, ['N', 'chla'], 
+                         cell_index=items['cell_index'])
 
     dp_gt = grid_tbl.depth*100000 + grid_tbl.profile
     dp_ge = grid_extrem.depth*100000 + grid_extrem.profile
-    ids = cat_utils.match_ids(dp_ge, dp_gt, require_in_match=True)
+    ids = pandas.Index(dp_gt).get_indexer(dp_ge)
+    assert np.all(ids >= 0)
     assert len(np.unique(ids)) == len(ids)
 
     grid_extrem['N_p'] = grid_tbl.N_p.values[ids]
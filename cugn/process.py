@@ -2,10 +2,14 @@
 
 # imports
 import os
+import time
 import xarray
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import numpy as np
+import h5netcdf
 
 import pandas
 
@@ -20,103 +24,445 @@ from cugn import defs as cugn_defs
 
 from IPython import embed
 
-def add_gsw():
+# Quantities derived by derive_gsw()
+derived_keys = ['CT', 'sigma0', 'SA', 'SO', 'N']
+
+def add_gsw(per_profile_latlon:bool=False, n_workers:int=1,
+            incremental:bool=False, chunk_size:int=None,
+            compress:dict=None):
     """ Add physical quantities to the Spray CUGN data
     using the TEOS-10 GSW package
+
+    The files are independent, so with n_workers > 1 they
+    are processed in parallel in a pool of processes.
+
+    Args:
+        per_profile_latlon (bool, optional): Use the lat, lon of each
+            profile instead of the median of the file. Defaults to False.
+        n_workers (int, optional): Number of processes. Defaults to 1.
+        incremental (bool, optional): Only derive the quantities of 
+            profiles not already in the CUGN_potential_ files. 
+            Defaults to False.
+        chunk_size (int, optional): Stream each file in chunks of
+            this many profiles to bound memory. Defaults to None.
+        compress (dict, optional): Options of output_encoding() for
+            a compressed, chunked output, e.g. dict(complevel=4, float32=True).
+            Defaults to None (uncompressed).
+
+    Returns:
+        dict: Wall time (s) to process each file
     """
     data_path = os.getenv('CUGN') 
 
     # Spray files
     spray_files = glob(os.path.join(data_path, 'CUGN_line_*.nc'))
 
-    for spray_file in spray_files:
-
-        print(f"Working on: {spray_file}")
-        # Load the data
-        ds = xarray.load_dataset(spray_file)
-
-        # Bad times?
-        bad = np.isnan(ds.time)
-        if np.any(bad):
-            tmp = pandas.Timestamp('1999-01-01')
-            ds.time[bad] = tmp
-            ds.time_uv[bad] = tmp
-
-        lat = np.nanmedian(ds.lat.data)
-        lon = np.nanmedian(ds.lon.data)
-
-        # Prep for new variables
-        CT = np.ones_like(ds.temperature.data) * np.nan
-        SA = np.ones_like(ds.temperature.data) * np.nan
-        OC = np.ones_like(ds.temperature.data) * np.nan
-        SO = np.ones_like(ds.temperature.data) * np.nan
-
-        # Loop on depths
-        for zz, z in enumerate(ds.depth.data):
-            # Pressure
-            p = conversions.p_from_z(-z, lat)
-
-            # SA
-            iSA = conversions.SA_from_SP(ds.salinity.data[zz,:], 
-                                        p, lon, lat)
-            SA[zz,:] = iSA
-
-            # CT
-            iCT = conversions.CT_from_t(iSA, ds.temperature.data[zz,:], 
-                                        p)
-            CT[zz,:] = iCT
-
-            # Oxygen
-            OC[zz,:] = gsw.O2sol(iSA, iCT, p, lon, lat)
-            SO[zz,:] = ds.doxy[zz,:] / OC[zz,:] 
-
-        # sigma0 
-        sigma0 = density.sigma0(SA, CT)
-
-        # Add to ds
-        ds['CT'] = (('depth', 'profile'), CT)
-        ds.CT.attrs = dict(units='Celsius', long_name='Conservative Temperature')
-        ds['sigma0'] = (('depth', 'profile'), sigma0)
-        ds.sigma0.attrs = dict(units='kg/m^3', long_name='potential density anomaly')
-        ds['SA'] = (('depth', 'profile'), SA)
-        ds.SA.attrs = dict(units='g/kg', long_name='Absolute Salinity')
-        ds['SO'] = (('depth', 'profile'), SO)
-        ds.SO.attrs = dict(long_name='Oxygen Saturation')
-
-        # Buoyancy
-        dsigmadz, _ = np.gradient(ds.sigma0.data, 
-                                  float(ds.depth[1]-ds.depth[0]))
-        dsigmadz[dsigmadz < 0.] = 0.
-        buoyfreq = np.sqrt(9.8/1025*dsigmadz)/(2*np.pi)*3600
-        ds['N'] = (('depth', 'profile'), buoyfreq)
-        ds.N.attrs = dict(long_name='Buoyancy Frequency', units='cycles/hour')
-
-        # Wipe out the 2020 trip to San Diego
-        dskeys =  ['temperature', 'salinity', 'chlorophyll_a', 'u', 'v', 
-                   'acoustic_backscatter', 'doxy', 'CT', 'sigma0', 'SA', 'SO', 'N']
-        if 'line_80' in spray_file:
-            dist, _ = cugn_utils.calc_dist_offset(
-                '80.0', ds.lon.values, ds.lat.values)
-            bad = dist < -50.
-            # Zero em!!
-            for key in dskeys:
-                ds[key].data[:,bad] = np.nan
-
-        # Mexican trip on Line 90
-        if 'line_90' in spray_file:
-            bad = ds.mission == 63
-            for key in dskeys:
-                ds[key].data[:,bad] = np.nan
-
-        # Write
-        new_spray_file = spray_file.replace('CUGN_', 'CUGN_potential_')
-        ds.to_netcdf(new_spray_file)
-        print(f"Wrote: {new_spray_file}")
+    process_one = partial(timed_process_spray_file, 
+                          per_profile_latlon=per_profile_latlon,
+                          incremental=incremental,
+                          chunk_size=chunk_size,
+                          compress=compress)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            timings = list(executor.map(process_one, spray_files))
+    else:
+        timings = [process_one(spray_file) for spray_file in spray_files]
+
+    # Report
+    timings = dict(timings)
+    for spray_file, dt in timings.items():
+        print(f"{os.path.basename(spray_file)}: {dt:.1f} s")
+
+    return timings
+
+def timed_process_spray_file(spray_file:str, **kwargs):
+    """ Run process_spray_file() and time it
+
+    Args:
+        spray_file (str): CUGN_line_*.nc file
+        **kwargs: passed to process_spray_file()
+
+    Returns:
+        tuple: spray_file, wall time (s)
+    """
+    tstart = time.perf_counter()
+    process_spray_file(spray_file, **kwargs)
+    return spray_file, time.perf_counter() - tstart
+
+def process_spray_file(spray_file:str, per_profile_latlon:bool=False,
+                       incremental:bool=False, chunk_size:int=None,
+                       compress:dict=None):
+    """ Add the physical quantities to one Spray CUGN file
+    and write the CUGN_potential_ file
+
+    Args:
+        spray_file (str): CUGN_line_*.nc file
+        per_profile_latlon (bool, optional): Use the lat, lon of each
+            profile instead of the median of the file. Defaults to False.
+        incremental (bool, optional): If the CUGN_potential_ file exists,
+            derive the quantities only for the profiles that are not 
+            already in it (by profile, time and mission) and append 
+            them;  any number of new profiles, including one, may be
+            added.  The new profiles use the median lat, lon of the 
+            full file while the existing ones are left as written. 
+            Defaults to False.
+        chunk_size (int, optional): If provided, stream the file in chunks
+            of this many profiles; see stream_spray_file(). Defaults to None.
+        compress (dict, optional): Options of output_encoding(). 
+            Defaults to None (uncompressed).
+
+    Returns:
+        str: Name of the output file
+    """
+    print(f"Working on: {spray_file}")
+    new_spray_file = spray_file.replace('CUGN_', 'CUGN_potential_')
+
+    if chunk_size is not None:
+        if incremental:
+            raise IOError("Cannot stream an incremental update")
+        return stream_spray_file(spray_file, new_spray_file, chunk_size,
+                                 per_profile_latlon=per_profile_latlon,
+                                 compress=compress)
+
+    # Load the data
+    ds = xarray.load_dataset(spray_file)
+    fix_times(ds)
+    latlon = (np.nanmedian(ds.lat.data), np.nanmedian(ds.lon.data))
+
+    # Only the new profiles?
+    old_ds = None
+    if incremental and os.path.isfile(new_spray_file):
+        old_ds = xarray.load_dataset(new_spray_file)
+        new = ~profile_keys(ds).isin(profile_keys(old_ds))
+        print(f"Found {np.sum(new)} new profiles")
+        if not np.any(new):
+            return new_spray_file
+        ds = ds.isel(profile=new)
+
+    # Derive
+    derive_gsw(ds, per_profile_latlon=per_profile_latlon, latlon=latlon)
+    mask_line(ds, spray_file)
+
+    # Append
+    if old_ds is not None:
+        ds = xarray.concat([old_ds, ds], dim='profile', 
+                           data_vars='minimal', coords='minimal',
+                           compat='override')
+
+    # Write
+    tmp_file = new_spray_file.replace('.nc', '_tmp.nc')
+    encoding = None if compress is None else output_encoding(ds, **compress)
+    ds.to_netcdf(tmp_file, encoding=encoding)
+    os.replace(tmp_file, new_spray_file)
+    print(f"Wrote: {new_spray_file}")
+
+    return new_spray_file
+
+def stream_spray_file(spray_file:str, new_spray_file:str, 
+                      chunk_size:int, per_profile_latlon:bool=False,
+                      compress:dict=None):
+    """ Derive the physical quantities of a Spray file in chunks
+    of profiles, writing each chunk to the output as it is done
+
+    All of the derivations (including the vertical gradient of
+    the buoyancy frequency) are per-profile, so peak memory is 
+    set by the chunk size rather than by the length of the file.
+
+    Args:
+        spray_file (str): CUGN_line_*.nc file
+        new_spray_file (str): Output file
+        chunk_size (int): Number of profiles per chunk
+        per_profile_latlon (bool, optional): Use the lat, lon of each
+            profile instead of the median of the file. Defaults to False.
+        compress (dict, optional): Options of output_encoding(). 
+            Defaults to None (uncompressed).
+
+    Returns:
+        str: Name of the output file
+    """
+    tmp_file = new_spray_file.replace('.nc', '_tmp.nc')
+
+    with xarray.open_dataset(spray_file) as raw:
+        nprof = raw.sizes['profile']
+        # Median position of the full file
+        latlon = (np.nanmedian(raw.lat.values), np.nanmedian(raw.lon.values))
+
+        for start in range(0, nprof, chunk_size):
+            ds = raw.isel(profile=slice(start, start+chunk_size)).load()
+
+            # Derive
+            derive_gsw(ds, per_profile_latlon=per_profile_latlon, 
+                       latlon=latlon)
+            mask_line(ds, spray_file)
+
+            # Write
+            if start == 0:
+                encoding = None if compress is None else output_encoding(
+                    ds, **compress)
+                ds.to_netcdf(tmp_file, engine='h5netcdf', encoding=encoding,
+                             unlimited_dims=['profile'])
+                with xarray.open_dataset(tmp_file, engine='h5netcdf') as out:
+                    encoding = {key: out[key].encoding for key in out.variables}
+            else:
+                append_profiles(tmp_file, ds, encoding)
+            print(f"Processed profiles {start}:{start+ds.sizes['profile']} of {nprof}")
+
+    os.replace(tmp_file, new_spray_file)
+    print(f"Wrote: {new_spray_file}")
+
+    return new_spray_file
+
+def append_profiles(outfile:str, ds:xarray.Dataset, encoding:dict):
+    """ Append profiles to a file written with an unlimited
+    profile dimension
+
+    Args:
+        outfile (str): NetCDF file written by h5netcdf
+        ds (xarray.Dataset): Profiles to append
+        encoding (dict): Encoding of each variable in the file;
+            used to encode ds the same way (e.g. time units)
+    """
+    # Encode as in the file
+    for key in ds.variables:
+        ds[key].encoding = {ekey: value for ekey, value in encoding[key].items()
+                            if ekey in ['units', 'calendar', 'dtype', '_FillValue']}
+    variables, _ = xarray.conventions.cf_encoder(dict(ds.variables), ds.attrs)
+
+    with h5netcdf.File(outfile, 'a') as f:
+        nold = f.dimensions['profile'].size
+        nnew = ds.sizes['profile']
+        f.resize_dimension('profile', nold + nnew)
+        for key, var in variables.items():
+            if 'profile' not in var.dims:
+                continue
+            slices = [slice(None)]*var.ndim
+            slices[var.dims.index('profile')] = slice(nold, nold+nnew)
+            f.variables[key][tuple(slices)] = var.values
+
+def output_encoding(ds:xarray.Dataset, complevel:int=4, 
+                    shuffle:bool=True, chunk_profiles:int=500,
+                    float32:bool=False):
+    """ NetCDF encoding for a compressed, profile-chunked
+    CUGN_potential_ file
+
+    Each chunk holds all depths of chunk_profiles profiles,
+    so a read of a few profiles only decompresses their chunks.
+
+    Args:
+        ds (xarray.Dataset): Dataset to write
+        complevel (int, optional): zlib level; 0 for no compression. 
+            Defaults to 4.
+        shuffle (bool, optional): Apply the HDF5 shuffle filter. 
+            Defaults to True.
+        chunk_profiles (int, optional): Profiles per chunk. Defaults to 500.
+        float32 (bool, optional): Store the derived quantities 
+            (derived_keys) as float32. Defaults to False.
+
+    Returns:
+        dict: encoding for ds.to_netcdf()
+    """
+    encoding = {}
+    for key in ds.variables:
+        var = ds[key]
+        if 'profile' not in var.dims:
+            continue
+        chunks = tuple([min(chunk_profiles, size) if dim == 'profile' else size 
+                        for dim, size in zip(var.dims, var.shape)])
+        encoding[key] = dict(chunksizes=chunks)
+        if complevel > 0:
+            encoding[key].update(dict(zlib=True, complevel=complevel,
+                                      shuffle=shuffle))
+        if float32 and key in derived_keys:
+            encoding[key]['dtype'] = 'float32'
+
+    return encoding
+
+def benchmark_layouts(potential_file:str, layouts:dict=None,
+                      nprof:int=100, ntrials:int=10, 
+                      outdir:str=None, seed:int=1234):
+    """ Time reads of a CUGN_potential_ file written with 
+    different layouts
+
+    Each layout is written to outdir and timed for a full 
+    load and for loading nprof consecutive profiles at 
+    random starting points.
+
+    Args:
+        potential_file (str): CUGN_potential_ file
+        layouts (dict, optional): name -> options of output_encoding(),
+            or None for the plain to_netcdf() layout. 
+            Defaults to a set of complevel, chunk and float32 choices.
+        nprof (int, optional): Number of profiles per partial read. Defaults to 100.
+        ntrials (int, optional): Number of partial reads. Defaults to 10.
+        outdir (str, optional): Where to write the files. Defaults to
+            the folder of potential_file.
+        seed (int, optional): Random seed. Defaults to 1234.
+
+    Returns:
+        pandas.DataFrame: size (MB), full and partial read times (s) per layout
+    """
+    if layouts is None:
+        layouts = dict(
+            contiguous=None,
+            chunked=dict(complevel=0),
+            zlib1=dict(complevel=1),
+            zlib4=dict(complevel=4),
+            zlib4_f32=dict(complevel=4, float32=True))
+    if outdir is None:
+        outdir = os.path.dirname(potential_file)
+
+    ds = xarray.load_dataset(potential_file)
+    ntot = ds.sizes['profile']
+    rng = np.random.default_rng(seed)
+    starts = rng.integers(0, max(ntot-nprof, 1), size=ntrials)
+
+    results = []
+    for name, options in layouts.items():
+        outfile = os.path.join(outdir, 
+            os.path.basename(potential_file).replace('.nc', f'_{name}.nc'))
+        encoding = None if options is None else output_encoding(ds, **options)
+        ds.to_netcdf(outfile, encoding=encoding)
+
+        # Full read
+        tstart = time.perf_counter()
+        xarray.load_dataset(outfile)
+        t_full = time.perf_counter() - tstart
+
+        # Partial reads
+        tstart = time.perf_counter()
+        for start in starts:
+            with xarray.open_dataset(outfile) as f:
+                f.isel(profile=slice(start, start+nprof)).load()
+        t_part = (time.perf_counter() - tstart) / ntrials
+
+        results.append(dict(layout=name, 
+                            size=os.path.getsize(outfile)/1024**2,
+                            t_full=t_full, t_partial=t_part))
+        os.remove(outfile)
+
+    return pandas.DataFrame(results)
+
+def profile_keys(ds:xarray.Dataset):
+    """ Keys identifying the profiles of a Spray dataset
+
+    Args:
+        ds (xarray.Dataset): Spray dataset
+
+    Returns:
+        pandas.MultiIndex: (profile, time, mission) of each profile
+    """
+    return pandas.MultiIndex.from_arrays(
+        [ds.profile.values, ds.time.values, ds.mission.values])
+
+def fix_times(ds:xarray.Dataset):
+    """ Replace bad (NaT) times of a Spray dataset (in place)
+
+    Args:
+        ds (xarray.Dataset): Spray dataset
+    """
+    bad = np.isnan(ds.time)
+    if np.any(bad):
+        tmp = pandas.Timestamp('1999-01-01')
+        ds.time[bad] = tmp
+        ds.time_uv[bad] = tmp
+
+def derive_gsw(ds:xarray.Dataset, per_profile_latlon:bool=False,
+               latlon:tuple=None):
+    """ Add CT, SA, SO, sigma0 and N to a Spray dataset (in place)
+
+    Each TEOS-10 conversion is a single call broadcast over 
+    the full (depth, profile) array, with the pressure 
+    computed as a (depth, 1) column (or (depth, profile)
+    for per-profile latitudes).
+
+    Args:
+        ds (xarray.Dataset): Spray dataset
+        per_profile_latlon (bool, optional): Use the lat, lon of each
+            profile instead of the median of the file.  Profiles
+            without a position use the median. Defaults to False.
+        latlon (tuple, optional): Median lat, lon to use, e.g. that 
+            of the full file when ds holds a subset of its profiles.
+            Defaults to the median of ds.
+    """
+    # Bad times?
+    fix_times(ds)
+
+    if latlon is None:
+        latlon = (np.nanmedian(ds.lat.data), np.nanmedian(ds.lon.data))
+    lat, lon = latlon
+    if per_profile_latlon:
+        lat = np.where(np.isfinite(ds.lat.data), ds.lat.data, lat)[None,:]
+        lon = np.where(np.isfinite(ds.lon.data), ds.lon.data, lon)[None,:]
+
+    # Prep for new variables
+    CT = np.empty_like(ds.temperature.data)
+    SA = np.empty_like(ds.temperature.data)
+    OC = np.empty_like(ds.temperature.data)
+    SO = np.empty_like(ds.temperature.data)
+
+    # Pressure
+    p = conversions.p_from_z(-ds.depth.data[:,None], lat)
+
+    # SA
+    conversions.SA_from_SP(ds.salinity.data, p, lon, lat, out=SA)
+
+    # CT
+    conversions.CT_from_t(SA, ds.temperature.data, p, out=CT)
+
+    # Oxygen
+    gsw.O2sol(SA, CT, p, lon, lat, out=OC)
+    np.divide(ds.doxy.data, OC, out=SO)
+
+    # sigma0 
+    sigma0 = density.sigma0(SA, CT)
+
+    # Add to ds
+    ds['CT'] = (('depth', 'profile'), CT)
+    ds.CT.attrs = dict(units='Celsius', long_name='Conservative Temperature')
+    ds['sigma0'] = (('depth', 'profile'), sigma0)
+    ds.sigma0.attrs = dict(units='kg/m^3', long_name='potential density anomaly')
+    ds['SA'] = (('depth', 'profile'), SA)
+    ds.SA.attrs = dict(units='g/kg', long_name='Absolute Salinity')
+    ds['SO'] = (('depth', 'profile'), SO)
+    ds.SO.attrs = dict(long_name='Oxygen Saturation')
+
+    # Buoyancy
+    dsigmadz = np.gradient(ds.sigma0.data, 
+                           float(ds.depth[1]-ds.depth[0]), axis=0)
+    dsigmadz[dsigmadz < 0.] = 0.
+    buoyfreq = np.sqrt(9.8/1025*dsigmadz)/(2*np.pi)*3600
+    ds['N'] = (('depth', 'profile'), buoyfreq)
+    ds.N.attrs = dict(long_name='Buoyancy Frequency', units='cycles/hour')
+
+def mask_line(ds:xarray.Dataset, spray_file:str):
+    """ Mask out the line-specific excursions (in place)
+
+    Args:
+        ds (xarray.Dataset): Spray dataset with the derived quantities
+        spray_file (str): Name of the Spray file; used to identify the line
+    """
+    # Wipe out the 2020 trip to San Diego
+    dskeys =  ['temperature', 'salinity', 'chlorophyll_a', 'u', 'v', 
+               'acoustic_backscatter', 'doxy', 'CT', 'sigma0', 'SA', 'SO', 'N']
+    if 'line_80' in spray_file:
+        dist, _ = cugn_utils.calc_dist_offset(
+            '80.0', ds.lon.values, ds.lat.values)
+        bad = dist < -50.
+        # Zero em!!
+        for key in dskeys:
+            ds[key].data[:,bad] = np.nan
+
+    # Mexican trip on Line 90
+    if 'line_90' in spray_file:
+        bad = ds.mission == 63
+        for key in dskeys:
+            ds[key].data[:,bad] = np.nan
 
 def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str, 
                   edges_outfile:str, min_counts:int=50, 
                   debug:bool=False,
-                  max_offset:float=90.):
+                  max_offset:float=90.,
+                  sort_by_cell:bool=False, sparse_edges:bool=False):
     """ Grid up density and salinity for a line
     to generate a table of grid indices and values
 
@@ -129,6 +475,10 @@ def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str,
             grid to be included in the analysis. Defaults to 50.
         debug (bool, optional): Debug. Defaults to False.
         max_offset (float, optional): Maximum offset from the line. Defaults to 90 km
+        sort_by_cell (bool, optional): If True, sort the table by (col, row)
+            so that each cell is a contiguous block of rows. Defaults to False.
+        sparse_edges (bool, optional): If True, store only the occupied 
+            cells of the counts in the edges file. Defaults to False.
     """
     # Dataset
     ds = xarray.load_dataset(line_file)
@@ -137,11 +487,15 @@ def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str,
     dist, offset = cugn_utils.calc_dist_offset(
             line, ds.lon.values, ds.lat.values)
     ok_off = (np.abs(offset) < max_offset) & np.isfinite(offset)
+    binning = grid_utils.cached_binning(
+        ds, cugn_io.binning_file(line_file), 
+        datafile=line_file).isel_profiles(ok_off)
     ds = ds.isel(profile=ok_off)
 
     # Generate the grid
     mean_oxyT, SA_edges, sigma_edges, countsT, \
-        grid_indices, gd_oxy, da_gd = grid_utils.gen_grid(ds, stat='mean')
+        grid_indices, gd_oxy, da_gd = grid_utils.gen_grid(
+            ds, stat='mean', binning=binning)
 
     # Table me
     gd_depth, gd_profile = np.where(da_gd)
@@ -155,17 +509,22 @@ def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str,
 
     
 
-    # Cut on counts
-    gd_rows, gd_cols = np.where(countsT > min_counts)
-
-    # Keep only the good ones
+    # Cut on counts, looking up the cell counts of each row
+    nrow, ncol = countsT.shape
+    rows, cols = grid_tbl.row.values, grid_tbl.col.values
+    in_grid = (rows >= 0) & (rows < nrow) & (cols >= 0) & (cols < ncol)
     keep = np.zeros(len(grid_tbl), dtype=bool)
-    for gd_row, gd_col in zip(gd_rows, gd_cols):
-        keep |= (grid_tbl.row == gd_row) & (grid_tbl.col == gd_col)
+    keep[in_grid] = countsT[rows[in_grid], cols[in_grid]] > min_counts
 
     grid_tbl = grid_tbl[keep].copy()
     grid_tbl.reset_index(inplace=True, drop=True)
 
+    # Index the rows by cell
+    cell_index = grid_utils.CellIndex.from_table(grid_tbl)
+    if sort_by_cell:
+        grid_tbl = grid_tbl.iloc[cell_index.perm].reset_index(drop=True)
+        cell_index = grid_utils.CellIndex.from_table(grid_tbl)
+
     if debug:
         grid_utils.fill_in_grid(grid_tbl, ds)
         tmin = pandas.Timestamp('2020-08-22')
@@ -175,7 +534,7 @@ def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str,
         embed(header='build_ds_grid: 150')
 
     # Generate DO percentile
-    grid_utils.find_perc(grid_tbl)
+    grid_utils.find_perc(grid_tbl, cell_index=cell_index)
 
     # Test
     #in_cell = (grid_tbl.row == 41) & (grid_tbl.col == 45)
@@ -185,10 +544,10 @@ def build_ds_grid(line:str, line_file:str, gridtbl_outfile:str,
     # Save
     if not debug:
         grid_tbl.to_parquet(gridtbl_outfile)
+        cell_index.save(cugn_io.cellidx_file(gridtbl_outfile))
         if edges_outfile is not None:
-            np.savez(edges_outfile, SA_edges=SA_edges, 
-                sigma_edges=sigma_edges,
-                counts=countsT)
+            cugn_io.write_edges(edges_outfile, SA_edges, sigma_edges,
+                                countsT, sparse=sparse_edges)
         print(f"Wrote: \n {gridtbl_outfile} \n {edges_outfile}")
 
 
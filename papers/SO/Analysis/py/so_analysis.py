@@ -125,10 +125,10 @@ def load_annual(line:str, zmax:int=9, dmax:float=100.):
     grid_tbl = grid_tbl[grid_tbl.dist <= dmax]
 
     # Calculate <DO> at every location
-    DO_annual = annualcycle.calc_for_grid(grid_tbl, line, 'oxumolkg')
-    SO_annual = annualcycle.calc_for_grid(grid_tbl, line, 'ox')
-    grid_tbl['ann_doxy'] = DO_annual
-    grid_tbl['ann_SO'] = SO_annual
+    annual = annualcycle.batch_calc_for_grid(grid_tbl, line, 
+                                             ['oxumolkg', 'ox'])
+    grid_tbl['ann_doxy'] = annual['oxumolkg']
+    grid_tbl['ann_SO'] = annual['ox']
 
     return grid_tbl  
 
@@ -1100,9 +1100,11 @@ def fig_joint_pdfs(line:str):
 
     # Grids
 
+    binning = grid_utils.load_binning(line, ds, axes=('SA', 'CT'))
+
     # Oxygen
     mean_oxy, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=('SA', 'CT'), stat='mean', variable='doxy')
+        ds, stat='mean', variable='doxy', binning=binning)
 
     # PDF
     dSA = xedges[1] - xedges[0]
@@ -1114,11 +1116,11 @@ def fig_joint_pdfs(line:str):
 
     # z
     mean_z, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=('SA', 'CT'), stat='mean', variable='depth')
+        ds, stat='mean', variable='depth', binning=binning)
 
     # chlorophyll
     mean_chl, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=('SA', 'CT'), stat='nanmean', variable='chlorophyll_a')
+        ds, stat='mean', variable='chlorophyll_a', binning=binning)
 
     fig = plt.figure(figsize=(12,10))
     plt.clf()
@@ -162,10 +162,12 @@ def fig_mean_DO_SO(line, outfile:str=None):
 
     # PDF
     axes=('SA', 'sigma0')
-    mean_oxy, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=axes, stat='mean', variable='doxy')
-    mean_SO, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=axes, stat='mean', variable='SO')
+    binning = grid_utils.load_binning(line, ds, axes=axes)
+    grids = grid_utils.gen_grids(ds, variables=('doxy', 'SO'),
+                                 stats=('mean',), binning=binning)
+    xedges, yedges = grids['edges']
+    mean_oxy = grids['grids']['doxy']['mean']
+    mean_SO = grids['grids']['SO']['mean']
 
     # Figure
     fig = plt.figure(figsize=(12,10))
@@ -706,6 +708,14 @@ def fig_extrema_cdfs(outfile:str='fig_N_cdfs.png', metric:str='N',
         val = np.nanpercentile(grid_extrem[metric], (10,90))
         print(f'Line: {line} -- percentiles={val}')
 
+        # Bootstrap of the control
+        boot = grid_utils.bootstrap_control(
+            grid_extrem, grid_tbl[cut_grid], metric, boost=5, 
+            nboot=1000, rng=1234)
+        print(f'Line: {line} -- median={boot["outlier_median"]:0.3f}, '
+              f'control median 95% range={np.percentile(boot["median"], (2.5, 97.5))}, '
+              f'KS distance 95% range={np.percentile(boot["ks"], (2.5, 97.5))}')
+
     plt.tight_layout(pad=0.8)#, w_pad=2.0)#, w_pad=0.8)
     plt.savefig(outfile, dpi=300)
     print(f"Saved: {outfile}")
@@ -268,10 +268,12 @@ def fig_mean_DO_SO(line, outfile:str=None):
 
     # PDF
     axes=('SA', 'sigma0')
-    mean_oxy, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=axes, stat='mean', variable='doxy')
-    mean_SO, xedges, yedges, counts, grid_indices, _, _ = grid_utils.gen_grid(
-        ds, axes=axes, stat='mean', variable='SO')
+    binning = grid_utils.load_binning(line, ds, axes=axes)
+    grids = grid_utils.gen_grids(ds, variables=('doxy', 'SO'),
+                                 stats=('mean',), binning=binning)
+    xedges, yedges = grids['edges']
+    mean_oxy = grids['grids']['doxy']['mean']
+    mean_SO = grids['grids']['SO']['mean']
 
     # Figure
     fig = plt.figure(figsize=(12,10))